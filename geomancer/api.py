@@ -1,14 +1,14 @@
 from flask import Blueprint, make_response, request, jsonify, \
     session as flask_session
-from geomancer.worker import DelayedResult, do_the_work
-from geomancer.helpers import import_class, get_geo_types, get_data_sources
-from geomancer.app_config import MANCERS, MANCER_KEYS
-from geomancer.mancers.geotype import GeoTypeEncoder
+from geomancer.worker import DelayedResult, enqueue_work
+from geomancer.registry import registry
+from geomancer.blob_store import get_blob_store
 import json
+import hashlib
 from redis import Redis
-from collections import OrderedDict
 
 redis = Redis()
+blob_store = get_blob_store()
 
 api = Blueprint('api', __name__)
 
@@ -47,17 +47,20 @@ def geomance_api():
     In this example, column 10 contains the city info and column 2 contains
     the state info.
 
+    Files with more than SHARD_ROWS rows are split into shards that are
+    processed in parallel by all the workers and merged at the end.
+
     Responds with a key that can be used to poll for results
     """
 
     field_defs = json.loads(request.data)
     if request.files:
-        file_contents = request.files['input_file'].read()
+        file_key = blob_store.put(request.files['input_file'].read())
         filename = request.files['input_file'].filename
     else:
-        file_contents = flask_session['file']
+        file_key = flask_session['file_key']
         filename = flask_session['filename']
-    session = do_the_work.delay(file_contents, field_defs, filename)
+    session = enqueue_work(file_key, field_defs, filename)
     resp = make_response(json.dumps({'session_key': session.key}))
     resp.headers['Content-Type'] = 'application/json'
     return resp
@@ -69,6 +72,9 @@ def geomance_results(session_key):
     """
     rv = DelayedResult(session_key)
     if rv.return_value is None:
+        progress = rv.progress
+        if progress:
+            return jsonify(ready=False, **progress)
         return jsonify(ready=False)
     redis.delete(session_key)
     result = rv.return_value
@@ -79,63 +85,47 @@ def data_sources():
     """ 
     Return a list of data sources
     """
-    mancers = None
-    if request.args.get('geo_type'):
-        mancers, errors = get_data_sources(request.args.get('geo_type'))
-    else:
-        mancers, errors = get_data_sources()
-    resp = make_response(json.dumps(mancers, cls=GeoTypeEncoder))
-    resp.headers['Content-Type'] = 'application/json'
-    return resp
+    geo_type = request.args.get('geo_type') or None
+    cached = registry.index().json('data_sources', geo_type)
+    if cached is None:
+        # nothing can be joined on a geo_type we have never heard of
+        cached = ('[]', hashlib.md5('[]').hexdigest())
+    return json_response(*cached)
 
 @api.route('/api/table-info/')
 def table_info():
     """ 
     Return a list of data sources
     """
-    columns = OrderedDict()
-    for mancer in MANCERS:
-        m = import_class(mancer)
-        api_key = MANCER_KEYS.get(m.machine_name)
-        try:
-            m = m(api_key=api_key)
-        except ImportError, e:
-            continue
-        col_info = m.get_metadata()
-        for col in col_info:
-            columns[col['table_id']] = {
-              'table_id': col['table_id'],
-              'human_name': col['human_name'],
-              'mancer': m.name, 
-              'columns': col['columns'],
-              'source_url': col['source_url'],
-            }
-    response = []
-    if request.args.get('table_id'):
-        table_id = request.args['table_id']
-        try:
-            response.append(columns[table_id])
-        except KeyError:
-            response.append({
-                'status': 'error',
-                'message': 'table_id %s not found' % table_id
-            })
-    else:
-        response.extend(columns.values())
-    resp = make_response(json.dumps(response))
-    resp.headers['Content-Type'] = 'application/json'
-    return resp
+    table_id = request.args.get('table_id')
+    cached = registry.index().json('table_info', table_id or None)
+    if cached is None:
+        body = json.dumps([{
+            'status': 'error',
+            'message': 'table_id %s not found' % table_id
+        }])
+        cached = (body, hashlib.md5(body).hexdigest())
+    return json_response(*cached)
 
 @api.route('/api/geo-types/')
 def geo_types():
     """ 
     Return a list of tables grouped by geo_type
     """
-    ordered_types = None
-    if request.args.get('geo_type'):
-        ordered_types, errors = get_geo_types(request.args.get('geo_type'))
-    else:
-        ordered_types, errors = get_geo_types()
-    resp = make_response(json.dumps(ordered_types, cls=GeoTypeEncoder))
+    geo_type = request.args.get('geo_type') or None
+    cached = registry.index().json('geo_types', geo_type)
+    if cached is None:
+        resp = jsonify(status='error', message='geo_type %s not found' % geo_type)
+        resp.status_code = 404
+        return resp
+    return json_response(*cached)
+
+def json_response(body, etag):
+    """
+    Responds with a pre-serialized JSON body, or a 304 if the client
+    already has the version matching etag.
+    """
+    resp = make_response(body)
     resp.headers['Content-Type'] = 'application/json'
-    return resp
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
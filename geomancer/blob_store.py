@@ -0,0 +1,134 @@
+import hashlib
+import os
+import time
+import zlib
+from os.path import join
+from tempfile import SpooledTemporaryFile
+from redis import Redis
+from geomancer.app_config import CACHE_DIR
+from geomancer.config import config
+
+BLOB_STORAGE = config('BLOB_STORAGE', 'redis')
+BLOB_FOLDER = config('BLOB_FOLDER', join(CACHE_DIR, 'geomancer_uploads'))
+BLOB_TTL = config('BLOB_TTL', 24 * 60 * 60)
+
+def blob_key(contents):
+    return hashlib.sha1(contents).hexdigest()
+
+class RedisBlobStore(object):
+    """
+    Keeps uploads zlib compressed in Redis, keyed by the SHA-1 of their
+    contents, so that the web nodes and every worker host can read them.
+    """
+
+    def __init__(self, redis=None, prefix='geomancer:blob:', ttl=BLOB_TTL):
+        if redis is None:
+            redis = Redis()
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def put(self, contents):
+        """
+        Stores contents (a byte string) and returns its key.
+        Storing the same contents twice only refreshes the TTL.
+        """
+        key = blob_key(contents)
+        if not self.redis.expire(self.prefix + key, self.ttl):
+            self.redis.setex(self.prefix + key, zlib.compress(contents), self.ttl)
+        return key
+
+    def get(self, key):
+        data = self.redis.get(self.prefix + key)
+        if data is None:
+            raise KeyError(key)
+        return zlib.decompress(data)
+
+    def open(self, key, chunk_size=1024 * 1024):
+        """
+        Returns a file-like object with the contents stored under key.
+        Decompression happens in chunks into a temporary file that only
+        stays in memory while it is small.
+        """
+        data = self.redis.get(self.prefix + key)
+        if data is None:
+            raise KeyError(key)
+        f = SpooledTemporaryFile(max_size=8 * chunk_size)
+        decompressor = zlib.decompressobj()
+        for i in xrange(0, len(data), chunk_size):
+            f.write(decompressor.decompress(data[i:i+chunk_size]))
+        f.write(decompressor.flush())
+        del data
+        f.seek(0)
+        return f
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+class DirectoryBlobStore(object):
+    """
+    Keeps uploads as files in a local directory, named by the SHA-1 of
+    their contents. Only useful when the web server and the workers
+    share a filesystem.
+    """
+
+    def __init__(self, path=BLOB_FOLDER, ttl=BLOB_TTL):
+        self.path = path
+        self.ttl = ttl
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _path(self, key):
+        return join(self.path, key)
+
+    def put(self, contents):
+        """
+        Stores contents (a byte string) and returns its key.
+        Uploads older than the TTL are removed along the way.
+        """
+        key = blob_key(contents)
+        path = self._path(key)
+        if os.path.exists(path):
+            os.utime(path, None)
+        else:
+            tmp_path = '%s.%s.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(contents)
+            os.rename(tmp_path, path)
+        self.prune()
+        return key
+
+    def get(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+    def open(self, key):
+        try:
+            return open(self._path(key), 'rb')
+        except IOError:
+            raise KeyError(key)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def prune(self):
+        cutoff = time.time() - self.ttl
+        for fname in os.listdir(self.path):
+            path = join(self.path, fname)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def get_blob_store():
+    """
+    Returns the blob store configured by BLOB_STORAGE
+    ('redis' or 'directory').
+    """
+    if BLOB_STORAGE == 'directory':
+        return DirectoryBlobStore()
+    return RedisBlobStore()
@@ -0,0 +1,224 @@
+import cPickle
+import os
+import sqlite3
+import threading
+import time
+from os.path import join
+from redis import Redis
+from geomancer.app_config import CACHE_DIR
+from geomancer.config import config
+
+SHARED_CACHE = config('SHARED_CACHE', 'redis')
+SHARED_CACHE_PATH = config('SHARED_CACHE_PATH', join(CACHE_DIR, 'geomancer_cache.sqlite'))
+
+GEO_LOOKUP_TTL = config('GEO_LOOKUP_TTL', 30 * 24 * 60 * 60)
+GEO_LOOKUP_MISS_TTL = config('GEO_LOOKUP_MISS_TTL', 24 * 60 * 60)
+
+MANCER_DATA_TTL = config('MANCER_DATA_TTL', 7 * 24 * 60 * 60)
+
+def thread_connection(local, path, setup=None):
+    """
+    Returns the current thread's connection to the SQLite file at path,
+    kept on the threading.local local. A new one (in WAL mode, so readers
+    don't block the writer) is opened on first use in each thread and
+    again after a fork; setup(conn) runs on each new connection to create
+    whatever tables the caller needs.
+    """
+    conn = getattr(local, 'conn', None)
+    if conn is None or local.pid != os.getpid():
+        conn = sqlite3.connect(path, timeout=30)
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        if setup is not None:
+            with conn:
+                setup(conn)
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+def _encode_key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf8')
+    return key
+
+class RedisStore(object):
+    """
+    Expiring key/value store kept in Redis so that every worker process
+    and host talking to the same Redis server shares it.
+    """
+    serializer = cPickle
+
+    def __init__(self, namespace, redis=None, prefix='geomancer:cache:'):
+        if redis is None:
+            redis = Redis()
+        self.redis = redis
+        self.prefix = '%s%s:' % (prefix, namespace)
+
+    def _key(self, key):
+        return self.prefix + _encode_key(key)
+
+    def get(self, key, default=None):
+        val = self.redis.get(self._key(key))
+        if val is None:
+            return default
+        return self.serializer.loads(val)
+
+    def get_many(self, keys):
+        """
+        Returns a dict with an entry for every key found in the store.
+        Keys that are missing or expired are left out.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        vals = self.redis.mget([self._key(k) for k in keys])
+        return {k: self.serializer.loads(v) for k, v in zip(keys, vals) \
+                if v is not None}
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for k, v in mapping.items():
+            val = self.serializer.dumps(v, protocol=-1)
+            if ttl:
+                pipe.setex(self._key(k), val, int(ttl))
+            else:
+                pipe.set(self._key(k), val)
+        pipe.execute()
+
+    def delete(self, key):
+        self.redis.delete(self._key(key))
+
+    def clear(self):
+        count = 0
+        for key in self.redis.scan_iter(match='%s*' % self.prefix):
+            count += self.redis.delete(key)
+        return count
+
+class SQLiteStore(object):
+    """
+    Expiring key/value store kept in a local SQLite file. Every process on
+    a host that points at the same file shares it. Connections are opened
+    per thread and reopened after a fork.
+    """
+    serializer = cPickle
+
+    def __init__(self, namespace, path=None):
+        self.namespace = namespace
+        self.path = path or SHARED_CACHE_PATH
+        self._local = threading.local()
+
+    def _setup(self, conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS store
+            (namespace text, key text, value blob, expires real,
+             PRIMARY KEY (namespace, key))''')
+
+    @property
+    def conn(self):
+        return thread_connection(self._local, self.path, self._setup)
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """
+        Returns a dict with an entry for every key found in the store.
+        Keys that are missing or expired are left out.
+        """
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        # SQLite caps the number of bound parameters per statement
+        for i in xrange(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            lookup = {_encode_key(k): k for k in chunk}
+            rows = self.conn.execute(
+                'SELECT key, value FROM store WHERE namespace=? AND key IN (%s) '
+                'AND (expires IS NULL OR expires > ?)' % ','.join('?' * len(chunk)),
+                [self.namespace] + lookup.keys() + [now])
+            for key, val in rows:
+                found[lookup[key]] = self.serializer.loads(str(val))
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        expires = time.time() + ttl if ttl else None
+        rows = [(self.namespace, _encode_key(k),
+                 sqlite3.Binary(self.serializer.dumps(v, protocol=-1)), expires) \
+                for k, v in mapping.items()]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO store VALUES (?,?,?,?)', rows)
+
+    def delete(self, key):
+        with self.conn:
+            self.conn.execute('DELETE FROM store WHERE namespace=? AND key=?',
+                              (self.namespace, _encode_key(key)))
+
+    def clear(self):
+        with self.conn:
+            cursor = self.conn.execute('DELETE FROM store WHERE namespace=?',
+                                       (self.namespace,))
+        return cursor.rowcount
+
+def get_store(namespace):
+    """
+    Returns the shared store for namespace using the backend
+    configured by SHARED_CACHE ('redis' or 'sqlite').
+    """
+    if SHARED_CACHE == 'sqlite':
+        return SQLiteStore(namespace)
+    return RedisStore(namespace)
+
+class GeoLookupCache(object):
+    """
+    Caches the geoid that a mancer's geo_lookup returned for a search term,
+    keyed by mancer machine_name, geo_type and the normalized term.
+    Misses (a geoid of None) are cached too, with a shorter TTL.
+    """
+
+    def __init__(self, store=None, ttl=GEO_LOOKUP_TTL, miss_ttl=GEO_LOOKUP_MISS_TTL):
+        if store is None:
+            store = get_store('geo_lookup')
+        self.store = store
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+
+    def normalize(self, term):
+        return u' '.join(term.lower().split())
+
+    def _key(self, machine_name, geo_type, term):
+        return u'%s:%s:%s' % (machine_name, geo_type, self.normalize(term))
+
+    def get_many(self, machine_name, geo_type, terms):
+        """
+        Returns a dict mapping each cached term to its geoid (which
+        may be None). Terms that are not in the cache are left out.
+        """
+        keys = {}
+        for term in terms:
+            keys.setdefault(self._key(machine_name, geo_type, term), []).append(term)
+        found = self.store.get_many(keys.keys())
+        return {term: v for k, v in found.items() for term in keys[k]}
+
+    def set_many(self, machine_name, geo_type, geoids):
+        """
+        geoids is a dict mapping search terms to the geoid that was
+        found for them, or None if the lookup came up empty.
+        """
+        hits, misses = {}, {}
+        for term, geoid in geoids.items():
+            key = self._key(machine_name, geo_type, term)
+            if geoid is None:
+                misses[key] = None
+            else:
+                hits[key] = geoid
+        self.store.set_many(hits, ttl=self.ttl)
+        self.store.set_many(misses, ttl=self.miss_ttl)
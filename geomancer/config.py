@@ -0,0 +1,9 @@
+from geomancer import app_config
+
+def config(name, default=None):
+    """
+    Returns the setting called name from app_config, or default when
+    app_config does not set it. Each optional setting is looked up on its
+    own, so setting one never hides another.
+    """
+    return getattr(app_config, name, default)
@@ -1,8 +1,8 @@
-from geomancer.app_config import MANCERS, MANCER_KEYS
-from collections import OrderedDict
+from geomancer.registry import registry
 import operator
 import re
 
+from geomancer.mancers.gazetteer import normalize
 from geomancer.mancers.geotype import City, State, County, SchoolDistrict, \
     CongressionalDistrict, Zip5, Zip9, StateFIPS, StateCountyFIPS, CensusTract
 
@@ -36,47 +36,7 @@ def import_class(cl):
     return getattr(m, classname)
 
 def get_geo_types(geo_type=None):
-    types = {}
-    columns = []
-    geo_types = []
-    errors = []
-
-    for mancer in MANCERS:
-        m = import_class(mancer)
-        api_key = MANCER_KEYS.get(m.machine_name)
-        try:
-            m = m(api_key=api_key)
-        except ImportError, e:
-            errors.append(e.message)
-            continue
-        for col in m.get_metadata():
-            geo_types.extend(col['geo_types'])
-        columns.extend(m.get_metadata())
-    for t in geo_types:
-        types[t.machine_name] = {}
-        types[t.machine_name]['info'] = t
-
-        tables = [{'human_name': c['human_name'], 
-                 'table_id': c['table_id'], 
-                 'source_name': c['source_name'], 
-                 'count': c['count'], 
-                 'source_url': c['source_url']} \
-                 for c in columns if t.machine_name in \
-                 [i.machine_name  for i in c['geo_types']]]
-
-        tables_sorted = sorted(tables, key=lambda x: x['human_name'])
-        types[t.machine_name]['tables'] = tables_sorted
-
-    if geo_type:
-        types = {geo_type: types[geo_type]}
-
-    types_sorted = sorted(types.values(), key=lambda x: x['info'].human_name)
-
-    results = []
-    for v in types_sorted:
-        results.append(v)
-
-    return results, errors
+    return registry.index().geo_types(geo_type), registry.errors()
 
 GEO_LOOKUP = {
     'state': ['state'],
@@ -90,58 +50,41 @@ GEO_LOOKUP = {
     'census_tract': ['census tract', 'us census tract'],
 }
 
-def guess_geotype(header, values):
-    guess = None
+# Share of a column's sample values that have to look like a geography
+# before we guess it
+GUESS_THRESHOLD = 0.8
+
+GEOTYPE_INSTANCES = [g() for g in GEOTYPES]
+
+def rank_geotypes(header, values, min_score=GUESS_THRESHOLD):
+    """
+    Scores every geotype by the fraction of the column's distinct sample
+    values that look like it and returns (machine_name, score) tuples,
+    best first. A header naming a geotype outright scores 1 and skips
+    the values. Geotypes that cannot reach min_score are left out; ties
+    go to the one that comes later in GEOTYPES.
+    """
+    header = normalize(header)
     for geotype, vals in GEO_LOOKUP.items():
         if header in vals:
-            return geotype
-    for geotype in GEOTYPES:
-        g = geotype()
-        valid, message = g.validate(values)
-        if valid:
-            guess = g.machine_name
-    return guess
-
-def get_data_sources(geo_type=None):
-    mancer_data = []
-    errors = []
-    for mancer in MANCERS:
-        m = import_class(mancer)
-        api_key = MANCER_KEYS.get(m.machine_name)
-        try:
-            m = m(api_key=api_key)
-        except ImportError, e:
-            errors.append(e.message)
-            continue
-        mancer_obj = {
-            "name": m.name, 
-            "machine_name": m.machine_name, 
-            "base_url": m.base_url, 
-            "info_url": m.info_url, 
-            "description": m.description, 
-            "data_types": {}
-        }
-        info = m.get_metadata()
-        for col in info:
-            if geo_type:
-                col_types = [i.machine_name for i in col['geo_types']]
-                if geo_type in col_types:
-                    mancer_obj["data_types"][col['table_id']] = col
-            else:
-                mancer_obj["data_types"][col['table_id']] = col
-            try:
-                mancer_obj["data_types"][col['table_id']]['geo_types'] = \
-                    sorted(mancer_obj["data_types"][col['table_id']]['geo_types'], 
-                           key=lambda x: x.human_name)
-            except KeyError:
-                pass
+            return [(geotype, 1.0)]
+    values = set([v for v in values if v])
+    ranked = []
+    for i, g in enumerate(GEOTYPE_INSTANCES):
+        score = g.score(values, min_score)
+        if score:
+            ranked.append((score, i, g.machine_name))
+    ranked.sort(reverse=True)
+    return [(name, s) for s, idx, name in ranked]
 
-        mancer_obj["data_types"] = sorted(mancer_obj["data_types"].values(), 
-                                          key=lambda x: x['human_name'])
-        if mancer_obj['data_types']:
-            mancer_data.append(mancer_obj)
+def guess_geotype(header, values):
+    ranked = rank_geotypes(header, values)
+    if ranked:
+        return ranked[0][0]
+    return None
 
-    return mancer_data, errors
+def get_data_sources(geo_type=None):
+    return registry.index().data_sources(geo_type), registry.errors()
 
 def find_geo_type(geo_type, col_idxs):
     if ';' not in geo_type:
@@ -1,12 +1,49 @@
 import scrapelib
 from urllib import urlencode
 import json
-import os
 from geomancer.app_config import CACHE_DIR
 from geomancer.helpers import encoded_dict
+from geomancer.mancers.http_cache import get_http_cache
 from string import punctuation
 import re
 from urlparse import urlparse
+import threading
+from requests.adapters import HTTPAdapter
+from geomancer.mancers.fetch import fetch_engine, host_limiter
+from geomancer.mancers.rate_limit import rate_limiter
+# re-exported for the mancers that strip punctuation from search terms
+from geomancer.mancers.states import PUNCTUATION
+from geomancer.config import config
+
+MANCER_CONCURRENCY = config('MANCER_CONCURRENCY', {})
+
+HTTP_POOL_CONNECTIONS = config('HTTP_POOL_CONNECTIONS', 10)
+HTTP_POOL_MAXSIZE = config('HTTP_POOL_MAXSIZE', max(MANCER_CONCURRENCY.values() + [10]))
+HTTP_POOL_BLOCK = config('HTTP_POOL_BLOCK', False)
+
+_adapter_lock = threading.Lock()
+_adapter = None
+
+def shared_adapter():
+    """
+    Returns the HTTPAdapter that every mancer in this process mounts, so
+    that keep-alive connections to each upstream host are pooled and
+    reused across mancer instances, jobs and threads. It keeps pools for
+    up to HTTP_POOL_CONNECTIONS hosts with up to HTTP_POOL_MAXSIZE idle
+    connections each; with HTTP_POOL_BLOCK, threads wait for a free
+    connection rather than opening one more. Retries are left to scrapelib.
+
+    Closing any mancer (which MancerRegistry does after a fork) drops the
+    pooled connections, so a forked child never shares the parent's.
+    """
+    global _adapter
+    if _adapter is None:
+        with _adapter_lock:
+            if _adapter is None:
+                _adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                       pool_maxsize=HTTP_POOL_MAXSIZE,
+                                       pool_block=HTTP_POOL_BLOCK)
+    return _adapter
 
 class MancerError(Exception):
     def __init__(self, message, body=None):
@@ -42,11 +79,14 @@ class BaseMancer(scrapelib.Scraper):
                                              retry_attempts=retry_attempts,
                                              retry_wait_seconds=retry_wait_seconds,
                                              header_func=header_func)
+
+        adapter = shared_adapter()
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
         
-        # We might want to talk about configuring an S3 backed cache for this
-        # so we don't run the risk of running out of disk space.
+        # HTTP_CACHE_BACKEND picks where responses are kept; see http_cache.py
         self.cache_dir = cache_dir
-        self.cache_storage = scrapelib.cache.FileCache(self.cache_dir)
+        self.cache_storage = get_http_cache(self.machine_name, self.cache_dir)
         self.cache_write_only = False
         
         # If subclass declares that an API Key is required and an API Key is not given, 
@@ -55,14 +95,35 @@ class BaseMancer(scrapelib.Scraper):
             raise ImportError('The %s mancer requires an API key and is disabled.' % self.name)
 
 
-    def flush_cache(self):
+    def close(self):
+        # Session.close would trip over scrapelib's FTP adapter, which
+        # cannot be closed; the HTTP connection pool is all there is to drop
+        for prefix in ('http://', 'https://'):
+            self.adapters[prefix].close()
+
+    def request(self, method, url, **kwargs):
+        try:
+            return super(BaseMancer, self).request(method, url, **kwargs)
+        finally:
+            # a shared cache may have handed this thread the job of fetching
+            # url; let the others waiting on it go even if the fetch failed
+            if self.cache_storage:
+                self.cache_storage.release_locks()
+
+    def send(self, request, **kwargs):
+        # only requests that actually go upstream (not cache hits, nor the
+        # waits between retries) count against the rate and host limits
+        rate_limiter.wait(self.machine_name)
+        with host_limiter.slot(urlparse(request.url).netloc):
+            return super(BaseMancer, self).send(request, **kwargs)
+
+    def flush_cache(self, path=None):
+        """
+        Removes this mancer's cached responses (only those whose URL path
+        starts with path, if given) and returns how many were removed.
+        """
         host = urlparse(self.base_url).netloc
-        count = 0
-        for f in os.listdir(self.cache_dir):
-            if f.startswith(host):
-                os.remove(os.path.join(self.cache_dir, f))
-                count += 1
-        return count
+        return self.cache_storage.flush(host, path=path)
 
     def get_metadata(self):
         """ 
@@ -127,6 +188,37 @@ class BaseMancer(scrapelib.Scraper):
 
         return {'term': search_term, 'geoid': search_term}
 
+    def geo_lookup_many(self, terms, geo_type=None):
+        """
+        Looks up a whole column of search terms at once and returns a
+        dict mapping each distinct term to its geoid (None if nothing
+        matched):
+
+        {
+          '<search_term>': '<full_geoid>',
+          ...etc...
+        }
+
+        The default calls geo_lookup once per distinct term, running up to
+        MANCER_CONCURRENCY[machine_name] of them at once (see concurrent_map).
+        Subclasses whose lookups are pure string work, or whose API takes
+        more than one term per request, should override this.
+        """
+        terms = list(set(terms))
+        def lookup(term):
+            return self.geo_lookup(term, geo_type=geo_type)['geoid']
+        return dict(zip(terms, self.concurrent_map(lookup, terms)))
+
+    def concurrent_map(self, func, items):
+        """
+        Like map(func, items), but runs up to
+        MANCER_CONCURRENCY[machine_name] calls at once on the process's
+        shared fetch engine. The first exception raised by func stops the
+        items that have not started yet and is re-raised here.
+        """
+        concurrency = MANCER_CONCURRENCY.get(self.machine_name, 1)
+        return fetch_engine.map(func, items, concurrency)
+
     def search(self, geo_ids=None, columns=None):
         """
         This method should send the search request to the API endpoint(s).
@@ -1,14 +1,19 @@
+import scrapelib
 from urllib import urlencode
 import json
 import os
 from geomancer.app_config import MANCER_KEYS
 from geomancer.helpers import encoded_dict
+from geomancer.cache import get_store, MANCER_DATA_TTL
 from geomancer.mancers.geotype import State, StateFIPS
-from geomancer.mancers.base import BaseMancer, MancerError
-from string import punctuation
-import re
+from geomancer.mancers.base import BaseMancer, MancerError, PUNCTUATION
+from geomancer.mancers.states import state_index, normalize_state_fips
 from urlparse import urlparse
-import us
+
+YEAR = 2013
+
+# parsed RegionalData results keyed by '<KeyCode>:<Year>'
+datasets = get_store('bea_datasets')
 
 class BureauEconomicAnalysis(BaseMancer):
     """ 
@@ -36,7 +41,7 @@ class BureauEconomicAnalysis(BaseMancer):
                 'description': '2013 Gross Domestic Product (GDP) (state annual product)',
                 'source_name': self.name,
                 'source_url': 'http://bea.gov/regional/index.htm',
-                'geo_types': [State()],
+                'geo_types': [State(), StateFIPS()],
                 'columns': ['2013 GDP'],
                 'count': 1
             },
@@ -46,7 +51,7 @@ class BureauEconomicAnalysis(BaseMancer):
                 'description': '2013 Real GDP (state annual product)',
                 'source_name': self.name,
                 'source_url': 'http://bea.gov/regional/index.htm',
-                'geo_types': [State()],
+                'geo_types': [State(), StateFIPS()],
                 'columns': ['2013 Real GDP'],
                 'count': 1
             },
@@ -56,7 +61,7 @@ class BureauEconomicAnalysis(BaseMancer):
                 'description': '2013 Per capita Real GDP (state annual product)',
                 'source_name': self.name,
                 'source_url': 'http://bea.gov/regional/index.htm',
-                'geo_types': [State()],
+                'geo_types': [State(), StateFIPS()],
                 'columns': ['2013 Per Capita Real GDP'],
                 'count': 1
             },
@@ -66,7 +71,7 @@ class BureauEconomicAnalysis(BaseMancer):
                 'description': '2013 Total Personal Income (state annual income)',
                 'source_name': self.name,
                 'source_url': 'http://bea.gov/regional/index.htm',
-                'geo_types': [State()],
+                'geo_types': [State(), StateFIPS()],
                 'columns': ['2013 Total Personal Income'],
                 'count': 1
             },
@@ -76,7 +81,7 @@ class BureauEconomicAnalysis(BaseMancer):
                 'description': '2013 Per Capita personal income (state annual income)',
                 'source_name': self.name,
                 'source_url': 'http://bea.gov/regional/index.htm',
-                'geo_types': [State()],
+                'geo_types': [State(), StateFIPS()],
                 'columns': ['2013 Per Capita Personal Income'],
                 'count': 1
             }
@@ -84,22 +89,57 @@ class BureauEconomicAnalysis(BaseMancer):
 
         return datasets
 
-    def lookup_state_name(self, term):
-        st = us.states.lookup(term)
-        if not st:
-            st = [s for s in us.STATES if getattr(s, 'ap_abbr') == term]
-        if st:
-            return st.name
-        else:
-            return term
-
     def geo_lookup(self, search_term, geo_type=None):
-        regex = re.compile('[%s]' % re.escape(punctuation))
-        search_term = regex.sub('', search_term)
+        return {'term': PUNCTUATION.sub('', search_term), 
+                'geoid': self.geo_lookup_many([search_term], geo_type)[search_term]}
+
+    def geo_lookup_many(self, terms, geo_type=None):
+        stripped = {t: PUNCTUATION.sub('', t) for t in set(terms)}
         if geo_type == 'state':
-            return {'term': search_term, 'geoid': self.lookup_state_name(search_term)}
+            attr = 'name'
+        elif geo_type == 'state_fips':
+            attr = 'fips'
+            stripped = {t: normalize_state_fips(s) for t, s in stripped.items()}
         else:
-            return {'term': search_term, 'geoid': search_term}
+            return stripped
+        states = state_index.lookup_many(stripped.values())
+        return {t: getattr(states[s], attr) if states[s] else s \
+                for t, s in stripped.items()}
+
+    def get_dataset(self, key_code, year=YEAR):
+        """
+        Returns the RegionalData values for key_code in year as a dict
+        with the values keyed by state name under 'by_name' and by
+        two digit state FIPS code under 'by_fips'. Each dataset is only
+        downloaded and parsed once per MANCER_DATA_TTL, and shared by
+        every worker through the datasets store.
+        """
+        key = '%s:%s' % (key_code, year)
+        dataset = datasets.get(key)
+        if dataset is not None:
+            return dataset
+        url = self.base_url+'/?UserID=%s&method=GetData&datasetname=RegionalData&KeyCode=%s&Year=%s&ResultFormat=json' %(self.api_key, key_code, year)
+        try:
+            response = self.urlopen(url)
+        except scrapelib.HTTPError, e:
+            try:
+                body = json.loads(e.body.json()['error'])
+            except ValueError:
+                body = None
+            except AttributeError:
+                body = e.body
+            raise MancerError('BEA API returned an error', body=body)
+        raw_results = json.loads(response)
+        dataset = {'by_name': {}, 'by_fips': {}}
+        for geo_data in raw_results['BEAAPI']['Results']['Data']:
+            value = geo_data['DataValue']
+            dataset['by_name'][geo_data['GeoName']] = value
+            geo_fips = geo_data.get('GeoFips', '')
+            # states come back as <state fips>000
+            if len(geo_fips) == 5 and geo_fips.endswith('000'):
+                dataset['by_fips'][geo_fips[:2]] = value
+        datasets.set(key, dataset, ttl=MANCER_DATA_TTL)
+        return dataset
 
     def search(self, geo_ids=None, columns=None):
 
@@ -113,27 +153,17 @@ class BureauEconomicAnalysis(BaseMancer):
 
         results = {'header':[]}
 
-        for col in columns:
-            url = self.base_url+'/?UserID=%s&method=GetData&datasetname=RegionalData&KeyCode=%s&Year=2013&ResultFormat=json' %(self.api_key, col)
-            try:
-                response = self.urlopen(url)
-            except scrapelib.HTTPError, e:
-                try:
-                    body = json.loads(e.body.json()['error'])
-                except ValueError:
-                    body = None
-                except AttributeError:
-                    body = e.body
-                raise MancerError('BEA API returned an error', body=body)
-            raw_results = json.loads(response)
-            raw_data = raw_results['BEAAPI']['Results']['Data']
+        for idx, col in enumerate(columns):
+            dataset = self.get_dataset(col)
             results['header'].append(column_names[col])
             for geo_type, geo_id in geo_ids:
-                if not results.get(geo_id):
-                    results[geo_id] = []
-                if geo_type == 'state': #### handle state fips?
-                    for geo_data in raw_data: #this is not efficient...make this better
-                        if geo_data['GeoName'] == geo_id:
-                            results[geo_id].append(geo_data['DataValue'])
-                            break
+                if geo_type == 'state_fips':
+                    value = dataset['by_fips'].get(geo_id)
+                else:
+                    value = dataset['by_name'].get(geo_id)
+                if value is None:
+                    continue
+                if geo_id not in results:
+                    results[geo_id] = [None] * len(columns)
+                results[geo_id][idx] = value
         return results
@@ -1,17 +1,47 @@
+import scrapelib
 from urllib import urlencode
+from cStringIO import StringIO
 import json
 import os
-from geomancer.app_config import MANCER_KEYS
+import threading
+from geomancer.app_config import MANCER_KEYS, CACHE_DIR
 from geomancer.helpers import encoded_dict
+from geomancer.cache import get_store, MANCER_DATA_TTL
 from geomancer.mancers.geotype import State, StateFIPS
-from geomancer.mancers.base import BaseMancer, MancerError
-from string import punctuation
-import re
+from geomancer.mancers.base import BaseMancer, MancerError, PUNCTUATION
+from geomancer.mancers.states import state_index, lookup_state, \
+    normalize_state_fips
 from urlparse import urlparse
-import us
-import requests
 import pandas as pd
 
+QCEW_YEAR = 2013
+OES_YEAR = '2014'
+
+# the most series ids the v2 API takes in one request with a registration key
+MAX_SERIES_PER_REQUEST = 50
+
+ALL_STATE_FIPS = ['01', '02', '04', '05', '06', '08', '09', '10',
+      '12', '13', '15', '16', '17', '18', '19', '20', '21', '22',
+      '23', '24', '25', '26', '27', '28', '29', '30', '31', '32', '33',
+      '34', '35', '36', '37', '38', '39', '40', '41', '42', '44',
+      '45', '46', '47', '48', '49', '50', '51', '53', '54', '55', '56']
+
+# OES values for every state keyed by year, as {stat_id: {state fips: value}}
+oes_data = get_store('bls_oes')
+
+QCEW_DTYPES = {
+    'area_fips': str,
+    'own_code': int,
+    'industry_code': str,
+    'annual_avg_estabs_count': float,
+    'annual_avg_emplvl': float,
+    'total_annual_wages': float,
+    'taxable_annual_wages': float,
+    'annual_contributions': float,
+    'annual_avg_wkly_wage': float,
+    'avg_annual_pay': float,
+}
+
 class BureauLaborStatistics(BaseMancer):
     """ 
     Subclassing the main BaseMancer class
@@ -26,9 +56,6 @@ class BureauLaborStatistics(BaseMancer):
     """
     api_key_required = True
 
-    # store the data for each column
-    # b/c bls api has low limit & it doesn't take long to grab all states
-    oes_column_data = {}
     # a mapping of bls oes series id data codes to geomancer column names
     oes_column_lookup = {   '13': '2014 Annual Wages - Median',
                             '12': '2014 Annual Wages - 25th Percentile',
@@ -44,6 +71,10 @@ class BureauLaborStatistics(BaseMancer):
                             'avg_annual_pay':'2013 Average Annual Pay (based on employment and wage levels)'
     }
 
+    # state fips -> list of qcew values (in qcew_column_lookup order), per year
+    qcew_summaries = {}
+    qcew_lock = threading.Lock()
+
     def __init__(self, api_key=None):
         self.api_key = MANCER_KEYS[self.machine_name]
         BaseMancer.__init__(self)
@@ -78,20 +109,9 @@ class BureauLaborStatistics(BaseMancer):
         # columns is a list consisting of table_ids from the possible values in get_metadata?
         results = {'header':[]}
 
-        all_state_fips = ['01', '02', '04', '05', '06', '08', '09', '10',
-              '12', '13', '15', '16', '17', '18', '19', '20', '21', '22',
-              '23', '24', '25', '26', '27', '28', '29', '30', '31', '32', '33',
-              '34', '35', '36', '37', '38', '39', '40', '41', '42', '44',
-              '45', '46', '47', '48', '49', '50', '51', '53', '54', '55', '56']
-
         for table_id in columns:
             if table_id == 'oes':
-                # only grab data when oes_column_data is not populated
-                if len(self.oes_column_data)==0:
-                    for col in self.oes_column_lookup:
-                        self.oes_column_data[col] = {}
-
-                    self.grab_oes_data(all_state_fips)
+                oes_column_data = self.oesGetData()
 
                 # looping through columns in OES data
                 for col in self.oes_column_lookup:
@@ -102,8 +122,8 @@ class BureauLaborStatistics(BaseMancer):
                         if not results.get(geo_id):
                             results[geo_id] = []
                         if geo_type == 'state' or geo_type =='state_fips':
-                            if geo_id in self.oes_column_data[col]:
-                                results[geo_id].append(self.oes_column_data[col][geo_id])
+                            if geo_id in oes_column_data[col]:
+                                results[geo_id].append(oes_column_data[col][geo_id])
                             else:
                                 results[geo_id].append("")
 
@@ -111,34 +131,36 @@ class BureauLaborStatistics(BaseMancer):
                 for col in self.qcew_column_lookup:
                     results['header'].append(self.qcew_column_lookup[col])
 
+                summaries = self.qcewGetSummaries()
                 for geo_type, geo_id in geo_ids:
                     if not results.get(geo_id):
                         results[geo_id] = []
                     if geo_type == 'state' or geo_type == 'state_fips':
-
-                        summary_df = self.qcewGetSummaryData(geo_id)
-                        for col in self.qcew_column_lookup:
-                            results[geo_id].append(summary_df[col][0])
+                        if geo_id in summaries:
+                            results[geo_id].extend(summaries[geo_id])
+                        else:
+                            results[geo_id].extend([""] * len(self.qcew_column_lookup))
 
         return results
 
     def geo_lookup(self, search_term, geo_type=None):
-        regex = re.compile('[%s]' % re.escape(punctuation))
-        search_term = regex.sub('', search_term)
+        search_term = PUNCTUATION.sub('', search_term)
+        if geo_type == 'state_fips':
+            search_term = normalize_state_fips(search_term)
         if geo_type == 'state' or geo_type == 'state_fips':
-            return {'term': search_term, 'geoid': self.lookup_state_name(search_term)}
+            return {'term': search_term, 'geoid': lookup_state(search_term, attr='fips')}
         else:
             return {'term': search_term, 'geoid': search_term}
 
-    # given a search term, returns state fips code
-    def lookup_state_name(self, term):
-        st = us.states.lookup(term)
-        if not st:
-            st = [s for s in us.STATES if getattr(s, 'ap_abbr') == term]
-        if st:
-            return st.fips
-        else:
-            return search_term
+    def geo_lookup_many(self, terms, geo_type=None):
+        stripped = {t: PUNCTUATION.sub('', t) for t in set(terms)}
+        if geo_type != 'state' and geo_type != 'state_fips':
+            return stripped
+        if geo_type == 'state_fips':
+            stripped = {t: normalize_state_fips(s) for t, s in stripped.items()}
+        states = state_index.lookup_many(stripped.values())
+        return {t: states[s].fips if states[s] else s \
+                for t, s in stripped.items()}
 
     def bls_oes_series_id(self, geo_id, stat_id):
         # documentation on constructing series ids at http://www.bls.gov/help/hlpforma.htm#OE
@@ -152,30 +174,86 @@ class BureauLaborStatistics(BaseMancer):
 
         return prefix+area_type+area_code+industry_code+occupation_code+datatype_code
 
-    def grab_oes_data(self, geo_ids=None):
-        # geo_ids is a list of state fips code strings
+    def oesGetData(self, year=OES_YEAR):
+        """
+        Returns {stat_id: {state fips: value}} with every OES statistic in
+        oes_column_lookup for every state. The BLS API has a low daily
+        limit, so the data is fetched MAX_SERIES_PER_REQUEST series at a
+        time and kept in the shared oes_data store for MANCER_DATA_TTL,
+        where every worker process (and restart) finds it.
+        """
+        data = oes_data.get(year)
+        if data is not None:
+            return data
+        series = {}
         for col in self.oes_column_lookup:
-            series_ids = []
-            for geo_id in geo_ids:
-                series_id = self.bls_oes_series_id(geo_id, col)
-                series_ids.append(series_id)
-
-            # make the request
-            headers = {'Content-type': 'application/json'}
-            data = json.dumps({"seriesid": series_ids,"startyear":"2014", "endyear":"2014", "registrationKey":self.api_key})
-            p = requests.post('http://api.bls.gov/publicAPI/v2/timeseries/data/', data=data, headers=headers)
+            for geo_id in ALL_STATE_FIPS:
+                series[self.bls_oes_series_id(geo_id, col)] = (col, geo_id)
+        series_ids = sorted(series)
+        data = {col: {} for col in self.oes_column_lookup}
+        headers = {'Content-type': 'application/json'}
+        for i in xrange(0, len(series_ids), MAX_SERIES_PER_REQUEST):
+            body = json.dumps({"seriesid": series_ids[i:i+MAX_SERIES_PER_REQUEST],
+                               "startyear": year, "endyear": year, 
+                               "registrationKey": self.api_key})
+            try:
+                p = self.post(self.base_url + '/', data=body, headers=headers)
+            except scrapelib.HTTPError, e:
+                raise MancerError('BLS API returned an error', body=e.body)
             json_data = json.loads(p.text)
-
-            self.oes_column_data[col] = {}
-            # loop through the json data and add it to oes_column_data[col][geo_id]
+            if json_data.get('status') != 'REQUEST_SUCCEEDED':
+                raise MancerError('BLS API returned an error', 
+                                  body=json_data.get('message'))
             for result in json_data['Results']['series']:
-                # grab state id from results series id
-                this_geo_id = result['seriesID'][4:6]
-                this_val = result['data'][0]['value']
-                self.oes_column_data[col][this_geo_id] = this_val
-
-    def qcewGetSummaryData(self, state_fips):
-        urlPath = "http://www.bls.gov/cew/data/api/2013/a/area/"+state_fips+"000.csv"
-        df = pd.read_csv(urlPath)
-        summary_df = df[(df['industry_code']=='10') & (df['own_code']==0)] # industry code 10 is all industries, own code 0 is all ownership
-        return summary_df
+                if result['seriesID'] in series and result['data']:
+                    col, geo_id = series[result['seriesID']]
+                    data[col][geo_id] = result['data'][0]['value']
+        oes_data.set(year, data, ttl=MANCER_DATA_TTL)
+        return data
+
+    def qcewGetSummaries(self, year=QCEW_YEAR):
+        """
+        Returns a dict mapping each state fips code to its all industries,
+        all ownerships QCEW values for year, in qcew_column_lookup order.
+
+        The QCEW industry file for industry 10 (all industries) has every
+        area in one CSV. It is downloaded once, cut down to the state
+        summary rows and the columns we use, and pickled to CACHE_DIR so
+        every worker on the host (and later restarts) can load it from
+        disk instead of downloading it again.
+        """
+        if year in self.qcew_summaries:
+            return self.qcew_summaries[year]
+        with self.qcew_lock:
+            if year not in self.qcew_summaries:
+                df = self.qcewLoadSummaryData(year)
+                cols = list(self.qcew_column_lookup)
+                self.qcew_summaries[year] = dict(zip(df.index, df[cols].values.tolist()))
+        return self.qcew_summaries[year]
+
+    def qcewLoadSummaryData(self, year=QCEW_YEAR):
+        fpath = os.path.join(CACHE_DIR, 'bls_qcew_%s.pkl' % year)
+        try:
+            return pd.read_pickle(fpath)
+        except (IOError, OSError):
+            pass
+        urlPath = "http://www.bls.gov/cew/data/api/%s/a/industry/10.csv" % year
+        try:
+            response = self.get(urlPath)
+        except scrapelib.HTTPError, e:
+            raise MancerError('BLS QCEW data could not be downloaded', body=e.body)
+        df = pd.read_csv(StringIO(response.content), usecols=QCEW_DTYPES.keys(), 
+                         dtype=QCEW_DTYPES)
+        # state summaries have area codes like 17000, own code 0 is all ownerships
+        df = df[df['area_fips'].str.contains(r'^\d\d000$') & (df['own_code']==0)]
+        df.index = df['area_fips'].str.slice(0, 2)
+        df = df[list(self.qcew_column_lookup)]
+        # read as floats in case other areas have blanks, but the state
+        # summaries are whole numbers
+        for col in df.columns:
+            if df[col].notnull().all():
+                df[col] = df[col].astype('int64')
+        tmp_path = '%s.%s.tmp' % (fpath, os.getpid())
+        df.to_pickle(tmp_path)
+        os.rename(tmp_path, fpath)
+        return df
@@ -1,15 +1,23 @@
 import scrapelib
-from urllib import urlencode
+from urllib import urlencode, quote
 import json
 import os
-import us
+import re
+import sys
+import threading
+import time
 from geomancer.helpers import encoded_dict
-from geomancer.mancers.base import BaseMancer, MancerError
+from geomancer.mancers.base import BaseMancer, MancerError, PUNCTUATION, \
+    MANCER_CONCURRENCY
+from geomancer.mancers.fetch import fetch_engine
 from geomancer.mancers.geotype import City, State, StateFIPS, StateCountyFIPS, \
-    Zip5, Zip9, County, SchoolDistrict, CongressionalDistrict, CensusTract
+    Zip5, Zip9, County, SchoolDistrict, CongressionalDistrict, CensusTract, \
+    split_state
+from geomancer.mancers.gazetteer import gazetteer
+from geomancer.mancers.states import state_index, lookup_state, \
+    normalize_state_fips
+from geomancer.cache import get_store, GEO_LOOKUP_TTL
 from geomancer.app_config import CACHE_DIR
-from string import punctuation
-import re
 
 SUMLEV_LOOKUP = {
     "city": "160,170,060",
@@ -25,6 +33,29 @@ SUMLEV_LOOKUP = {
     "census_tract": "140",
 }
 
+# Bounds for the number of geoids sent to /data/show/latest at once. Chunks
+# shrink when responses come back slower than SLOW_RESPONSE seconds, grow
+# again when they are faster than FAST_RESPONSE, and never make the URL
+# longer than MAX_URL_LENGTH.
+MIN_CHUNK_SIZE = 10
+MAX_CHUNK_SIZE = 100
+MAX_URL_LENGTH = 4000
+SLOW_RESPONSE = 10
+FAST_RESPONSE = 2
+
+MISSING_GEOIDS = re.compile(r"The (.+) release doesn't include GeoID\(s\) (.+?)\.?$")
+
+# geoids the current ACS release is known not to include, keyed by
+# '<release name>:<geoid>', plus the name of that release under 'release'
+missing_geoids = get_store('census_reporter_missing')
+
+class MissingGeoIDs(Exception):
+    def __init__(self, release, geoids):
+        Exception.__init__(self, 'The %s release is missing %s' % \
+            (release, ', '.join(geoids)))
+        self.release = release
+        self.geoids = geoids
+
 class CensusReporter(BaseMancer):
     """ 
     Subclassing the main BaseMancer class
@@ -37,6 +68,7 @@ class CensusReporter(BaseMancer):
     description = """ 
         Demographic data from the 2013 American Community Survey.
     """
+    release = None
 
     def get_metadata(self):
         table_ids = [
@@ -81,14 +113,84 @@ class CensusReporter(BaseMancer):
             columns.append(d)
         return columns
 
-    def lookup_state(self, term, attr='name'):
-        st = us.states.lookup(term)
-        if not st:
-            st = [s for s in us.STATES if getattr(s, 'ap_abbr') == term]
-        if st:
-            return getattr(st, attr)
-        else:
-            return term
+    def local_geoid(self, search_term, geo_type):
+        """
+        Resolves states, counties, cities and school districts from the
+        state index and the gazetteers that ship with geomancer. Returns
+        None when there is no local match, which includes names that do
+        not say which state they are in.
+        """
+        if geo_type == 'state':
+            st = state_index.lookup(search_term)
+            if st:
+                return '04000US%s' % st.fips
+            return None
+        name, state = split_state(search_term)
+        if not state:
+            return None
+        if geo_type == 'county':
+            for n in (name, u'{0} county'.format(name)):
+                fips = gazetteer.county_fips_by_name.get((n, state))
+                if fips:
+                    return '05000US%s' % fips
+        elif geo_type == 'city':
+            geoid = gazetteer.place_geoids_by_name.get((name, state))
+            if geoid:
+                return '16000US%s' % geoid
+        elif geo_type == 'school_district':
+            return gazetteer.school_district_geoids_by_name.get((name, state))
+        return None
+
+    def offline_lookup(self, search_term, geo_type):
+        """
+        Works out the geoid for terms that need no call to /geo/search:
+        congressional districts, FIPS codes, census tracts and whatever
+        local_geoid can resolve. Returns (True, geoid) for those, where
+        geoid may be None for invalid FIPS codes, and (False, None) for
+        everything else.
+        """
+        if geo_type == 'congress_district':
+            geoid = None
+            dist, st = search_term.rsplit(',', 1)
+            fips = lookup_state(st.strip(), attr='fips')
+            try:
+                dist_num = str(int(dist.split(' ')[-1]))
+            except ValueError:
+                dist_num = '00'
+            if fips and dist_num:
+                geoid = '50000US{0}{1}'\
+                    .format(fips, dist_num.zfill(2))
+            return True, geoid
+        geoid = self.local_geoid(search_term, geo_type)
+        if geoid:
+            return True, geoid
+        search_term = PUNCTUATION.sub('', search_term)
+        if geo_type == 'state_fips':
+            search_term = normalize_state_fips(search_term)
+        if geo_type in ['census_tract', 'state_fips']:
+            return True, '%s00US%s' % (SUMLEV_LOOKUP[geo_type], search_term)
+        if geo_type == 'state_county_fips':
+            if search_term in gazetteer.county_fips:
+                return True, '05000US%s' % search_term
+            return True, None
+        return False, None
+
+    def geo_lookup_many(self, terms, geo_type=None):
+        """
+        Resolves everything offline_lookup can without the API and sends
+        only the rest to /geo/search, concurrently.
+        """
+        geoids = {}
+        remote = []
+        for term in set(terms):
+            resolved, geoid = self.offline_lookup(term, geo_type)
+            if resolved:
+                geoids[term] = geoid
+            else:
+                remote.append(term)
+        if remote:
+            geoids.update(super(CensusReporter, self).geo_lookup_many(remote, geo_type))
+        return geoids
 
     def geo_lookup(self, search_term, geo_type=None):
         """ 
@@ -102,45 +204,20 @@ class CensusReporter(BaseMancer):
         }
 
         """
-        if geo_type == 'congress_district':
-            geoid = None
-            dist, st = search_term.rsplit(',', 1)
-            fips = self.lookup_state(st.strip(), attr='fips')
-            try:
-                dist_num = str(int(dist.split(' ')[-1]))
-            except ValueError:
-                dist_num = '00'
-            if fips and dist_num:
-                geoid = '50000US{0}{1}'\
-                    .format(fips, dist_num.zfill(2))
+        resolved, geoid = self.offline_lookup(search_term, geo_type)
+        if resolved:
             return {
                 'term': search_term,
                 'geoid': geoid
             }
-        regex = re.compile('[%s]' % re.escape(punctuation))
-        search_term = regex.sub('', search_term)
-        if geo_type in ['census_tract', 'state_fips']:
-            return {
-                'term': search_term,
-                'geoid': '%s00US%s' % (SUMLEV_LOOKUP[geo_type], search_term)
-            }
-        if geo_type == 'state_county_fips':
-            resp = {
-                'term': search_term,
-                'geoid': None
-                }
-            g = StateCountyFIPS()
-            valid, message = g.validate([search_term])
-            if valid:
-                resp['geoid'] = '05000US%s' % search_term
-            return resp
+        search_term = PUNCTUATION.sub('', search_term)
         q_dict = {'q': search_term}
         if geo_type:
             q_dict['sumlevs'] = SUMLEV_LOOKUP[geo_type]
             if geo_type == 'zip_5':
                 q_dict['q'] = search_term.zfill(5)
             if geo_type == 'state':
-                q_dict['q'] = self.lookup_state(search_term)
+                q_dict['q'] = lookup_state(search_term)
         q_dict = encoded_dict(q_dict)
 
         params = urlencode(q_dict)
@@ -166,11 +243,7 @@ class CensusReporter(BaseMancer):
             }
         return results
    
-    def _chunk_geoids(self, geo_ids):
-        for i in xrange(0, len(geo_ids), 100):
-            yield geo_ids[i:i+100]
-
-    def _try_search(self, gids, columns, bad_gids=[]):
+    def _fetch_data(self, gids, columns):
         query = {
             'table_ids': ','.join(columns),
             'geo_ids': ','.join(sorted([g[1] for g in gids])),
@@ -179,23 +252,131 @@ class CensusReporter(BaseMancer):
         try:
             response = self.urlopen('%s/data/show/latest?%s' % (self.base_url, params))
         except scrapelib.HTTPError, e:
+            body = e.body
             try:
-                body = json.loads(e.body.json()['error'])
-            except ValueError:
-                body = None
-            except AttributeError:
-                body = e.body
-            if 'The ACS 2013 5-year release doesn\'t include GeoID(s)' in body:
-                error = json.loads(body)
-                bad_gids.append(error['error'].rsplit(' ',1)[1].replace('.', ''))
-                for idx,gid in enumerate(gids):
-                    if gid[1] in bad_gids:
-                        gids.pop(idx)
-                response = self._try_search(gids, columns, bad_gids=bad_gids)
-            else:
-                raise MancerError('Census Reporter API returned an error', body=body)
-        return response
+                message = json.loads(body)['error']
+            except (ValueError, KeyError, TypeError):
+                message = None
+            match = MISSING_GEOIDS.search(message or '')
+            if match:
+                release, geoids = match.groups()
+                raise MissingGeoIDs(release, 
+                    set([g.strip() for g in geoids.split(',') if g.strip()]))
+            raise MancerError('Census Reporter API returned an error', body=body)
+        results = json.loads(response)
+        release = results.get('release', {}).get('name')
+        if release and release != self.release:
+            self.release = release
+            missing_geoids.set('release', release)
+        return results
 
+    def _try_search(self, gids, columns, retry=True):
+        """
+        Fetches gids from /data/show/latest and returns the parsed response,
+        leaving out the geoids the release does not include. Every geoid the
+        error names is dropped at once and the rest retried; if that still
+        fails the chunk is bisected, so each further missing geoid costs
+        a couple of requests rather than a round trip for the whole chunk.
+        Missing geoids are remembered in missing_geoids for later jobs.
+        """
+        try:
+            return self._fetch_data(gids, columns)
+        except MissingGeoIDs, e:
+            self._remember_missing(e.release, e.geoids)
+            remaining = [g for g in gids if g[1] not in e.geoids]
+        if len(remaining) == len(gids) == 1:
+            # the error named nothing we could match up, but there is
+            # only one geoid it could be about
+            self._remember_missing(e.release, [gids[0][1]])
+            remaining = []
+        if not remaining:
+            return {'data': {}}
+        if (retry and len(remaining) < len(gids)) or len(remaining) == 1:
+            return self._try_search(remaining, columns, retry=False)
+        half = len(remaining) / 2
+        results = {'data': {}}
+        for part in (remaining[:half], remaining[half:]):
+            part_results = self._try_search(part, columns, retry=False)
+            if part_results['data']:
+                results['tables'] = part_results['tables']
+                results['data'].update(part_results['data'])
+        return results
+
+    def _remember_missing(self, release, geoids):
+        self.release = release
+        missing_geoids.set('release', release)
+        missing_geoids.set_many(
+            {'%s:%s' % (release, g): True for g in geoids}, ttl=GEO_LOOKUP_TTL)
+
+    def known_missing(self, geo_ids):
+        """
+        Returns the set of geoids (out of geo_ids, a list of
+        (geo_type, geoid) tuples) that an earlier request found the
+        current release does not include.
+        """
+        release = self.release or missing_geoids.get('release')
+        if not release or not geo_ids:
+            return set()
+        keys = {'%s:%s' % (release, g[1]): g[1] for g in geo_ids}
+        return set([keys[k] for k in missing_geoids.get_many(keys.keys())])
+
+    def _fetch_chunks(self, geo_ids, columns, handle):
+        """
+        Fetches geo_ids from /data/show/latest in chunks, with up to
+        MANCER_CONCURRENCY['census_reporter'] requests in flight on the
+        shared fetch engine, and calls handle(gids, raw_results) for each chunk. Calls to handle
+        never overlap. The first error stops the remaining chunks and is
+        re-raised here.
+        """
+        lock = threading.Lock()
+        state = {'next': 0, 'size': MAX_CHUNK_SIZE}
+        errors = []
+        base_len = len('%s/data/show/latest?%s&geo_ids=' % \
+            (self.base_url, urlencode({'table_ids': ','.join(columns)})))
+
+        def next_chunk():
+            with lock:
+                start = state['next']
+                if errors or start >= len(geo_ids):
+                    return None
+                end = start
+                url_len = base_len
+                while end < len(geo_ids) and end - start < state['size']:
+                    # the joining comma is quoted as %2C
+                    url_len += len(quote(geo_ids[end][1])) + 3
+                    if url_len > MAX_URL_LENGTH and end > start:
+                        break
+                    end += 1
+                state['next'] = end
+                return list(geo_ids[start:end])
+
+        def work():
+            while True:
+                gids = next_chunk()
+                if gids is None:
+                    return
+                started = time.time()
+                try:
+                    raw_results = self._try_search(gids, columns)
+                    elapsed = time.time() - started
+                    with lock:
+                        if elapsed > SLOW_RESPONSE:
+                            state['size'] = max(MIN_CHUNK_SIZE, state['size'] / 2)
+                        elif elapsed < FAST_RESPONSE:
+                            state['size'] = min(MAX_CHUNK_SIZE, state['size'] * 2)
+                        handle(gids, raw_results)
+                except Exception:
+                    with lock:
+                        errors.append(sys.exc_info())
+                    return
+
+        concurrency = MANCER_CONCURRENCY.get(self.machine_name, 1)
+        chunks = (len(geo_ids) + MIN_CHUNK_SIZE - 1) / MIN_CHUNK_SIZE
+        concurrency = max(1, min(concurrency, chunks))
+        fetch_engine.map(lambda i: work(), range(concurrency), concurrency)
+        if errors:
+            exc_type, exc_value, tb = errors[0]
+            raise exc_type, exc_value, tb
 
     def search(self, geo_ids=None, columns=None):
         """ 
@@ -232,22 +413,23 @@ class CensusReporter(BaseMancer):
                                     'Per Capita Income in the Past 12 Months (In 2013 Inflation-adjusted Dollars)',
                                     ]
 
+        # (table_id, offset into a row, [detail_ids]) for each table,
+        # worked out from the first response since every chunk
+        # describes the tables the same way
+        layout = []
         results = {'header': []}
-        for gids in self._chunk_geoids(geo_ids):
-            raw_results = self._try_search(gids, columns)
-            raw_results = json.loads(raw_results)
-            for geo_type, geo_id in gids:
-                if not results.get(geo_id):
-                    results[geo_id] = []
+
+        def add_chunk(gids, raw_results):
+            if not raw_results['data']:
+                return
+            if not layout:
+                offset = 0
                 for table_id in columns:
                     table_info = raw_results['tables'][table_id]
-                    title = table_info['title']
+                    table_title = table_info['title']
                     detail_ids = [k for k in table_info['columns'].keys() \
                         if table_info['columns'][k].get('indent') is not None]
-                    denominator = table_info['denominator_column_id']
                     for detail_id in detail_ids:
-                        table_title = table_info['title']
-                        column_title = None
                         detail_title = table_info['columns'][detail_id]['name']
                         if table_title in table_name_exceptions:
                             column_title = detail_title
@@ -255,12 +437,24 @@ class CensusReporter(BaseMancer):
                             column_title = 'Median Value, Owner-Occupied Housing Units'
                         else:
                             column_title = '%s, %s' % (table_title, detail_title,)
-                        if column_title not in results['header']:
-                            results['header'].extend([column_title, '%s (error margin)' % column_title])
+                        results['header'].extend([column_title, '%s (error margin)' % column_title])
+                    layout.append((table_id, offset, detail_ids))
+                    offset += 2 * len(detail_ids)
+            width = len(results['header'])
+            for geo_type, geo_id in gids:
+                data = raw_results['data'].get(geo_id)
+                if data is None:
+                    continue
+                row = [None] * width
+                for table_id, offset, detail_ids in layout:
+                    detail_info = data[table_id]
+                    estimate, error = detail_info['estimate'], detail_info['error']
+                    for i, detail_id in enumerate(detail_ids):
+                        row[offset + 2 * i] = estimate[detail_id]
+                        row[offset + 2 * i + 1] = error[detail_id]
+                results[geo_id] = row
 
-                        detail_info = raw_results['data'][geo_id][table_id]
-                        results[geo_id].extend([
-                            detail_info['estimate'][detail_id], 
-                            detail_info['error'][detail_id],
-                        ])
+        missing = self.known_missing(geo_ids)
+        geo_ids = [g for g in geo_ids if g[1] not in missing]
+        self._fetch_chunks(geo_ids, columns, add_chunk)
         return results
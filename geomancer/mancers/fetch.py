@@ -0,0 +1,131 @@
+import os
+import sys
+import threading
+import Queue
+from geomancer.config import config
+
+FETCH_THREADS = config('FETCH_THREADS', 100)
+FETCH_HOST_LIMITS = config('FETCH_HOST_LIMITS', {})
+FETCH_HOST_LIMIT = config('FETCH_HOST_LIMIT', 50)
+
+class FetchEngine(object):
+    """
+    A pool of threads shared by every mancer in the process that runs
+    their upstream requests (and whatever parsing goes with them) side by
+    side. Work goes through the mancers' own urlopen/get/post, so the
+    HTTP cache, scrapelib's retries and the host limits all still apply.
+
+    The threads are started on first use, and again in a forked child.
+    map() called from one of the engine's own threads runs inline, so
+    nested calls can't tie the pool up waiting on itself.
+    """
+
+    def __init__(self, threads=FETCH_THREADS):
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._queue = None
+        self._pid = None
+
+    def _worker(self, queue):
+        self._local.in_engine = True
+        while True:
+            func = queue.get()
+            func()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                queue = Queue.Queue()
+                for i in range(self.threads):
+                    t = threading.Thread(target=self._worker, args=(queue,))
+                    t.daemon = True
+                    t.start()
+                self._queue = queue
+                self._pid = os.getpid()
+
+    def map(self, func, items, concurrency):
+        """
+        Like map(func, items), with up to concurrency calls running at
+        once (the calling thread takes one of them). The first exception
+        raised by func stops the items that have not started yet and is
+        re-raised here.
+        """
+        items = list(items)
+        concurrency = min(concurrency, len(items))
+        if concurrency <= 1 or getattr(self._local, 'in_engine', False):
+            return [func(item) for item in items]
+        self._start()
+
+        lock = threading.Lock()
+        done = threading.Event()
+        results = [None] * len(items)
+        errors = []
+        state = {'next': 0, 'running': concurrency}
+
+        def run():
+            try:
+                while True:
+                    with lock:
+                        i = state['next']
+                        if errors or i >= len(items):
+                            return
+                        state['next'] += 1
+                    try:
+                        results[i] = func(items[i])
+                    except Exception:
+                        with lock:
+                            errors.append(sys.exc_info())
+                        return
+            finally:
+                with lock:
+                    state['running'] -= 1
+                    if state['running'] == 0:
+                        done.set()
+
+        for i in range(concurrency - 1):
+            self._queue.put(run)
+        run()
+        done.wait()
+        if errors:
+            exc_type, exc_value, tb = errors[0]
+            raise exc_type, exc_value, tb
+        return results
+
+class HostLimiter(object):
+    """
+    Caps the number of requests in flight from this process to each
+    upstream host, whichever mancer or thread they come from: at most
+    limits[host], or default for hosts that are not listed.
+    """
+
+    def __init__(self, limits=FETCH_HOST_LIMITS, default=FETCH_HOST_LIMIT):
+        self.limits = limits
+        self.default = default
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._pid = None
+
+    def slot(self, host):
+        """
+        Returns the semaphore to hold while talking to host.
+        """
+        if self._pid != os.getpid():
+            # a forked child can't trust the parent's counts
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._slots = {}
+                    self._pid = os.getpid()
+        try:
+            return self._slots[host]
+        except KeyError:
+            with self._lock:
+                if host not in self._slots:
+                    limit = self.limits.get(host, self.default)
+                    self._slots[host] = threading.BoundedSemaphore(limit)
+                return self._slots[host]
+
+fetch_engine = FetchEngine()
+host_limiter = HostLimiter()
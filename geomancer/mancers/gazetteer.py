@@ -0,0 +1,174 @@
+import csv
+import re
+import threading
+from os.path import join, abspath, dirname
+
+GAZDIR = join(dirname(abspath(__file__)), 'gazetteers')
+
+# the legal/statistical area description on the end of a (normalized)
+# place name, which nobody types: "chicago city" is just "chicago"
+PLACE_SUFFIX = re.compile(r' (city|town|village|borough|cdp|municipality|'
+                          r'comunidad|zona urbana)( \(balance\))?$')
+
+def normalize(name):
+    """
+    Lowercases name and collapses runs of whitespace so that
+    lookups do not depend on how a spreadsheet was typed up.
+    """
+    return u' '.join(name.lower().split())
+
+class Gazetteer(object):
+    """
+    The Census gazetteer files in GAZDIR, each parsed once per process
+    the first time it is needed and kept as frozensets and dicts:
+
+      county_names           every normalized county name
+      counties_by_state      state abbreviation -> frozenset of county names
+      county_fips            5 digit FIPS code -> (county name, state abbreviation)
+      county_fips_by_name    (normalized county name, state abbreviation) -> FIPS code
+      place_geoids_by_name   (normalized place name, state abbreviation) -> 7 digit
+                             Census place GEOID, also under the name without
+                             its "city", "town", "CDP" etc. when that is unambiguous
+      school_district_names  every normalized school district name
+      school_districts_by_state  state abbreviation -> frozenset of district names
+      school_district_geoids_by_name  (normalized district name, state
+                             abbreviation) -> full Census Reporter geoid
+
+    Everything is shared by every caller; treat it as read-only.
+    """
+
+    def __init__(self, path=GAZDIR):
+        self.path = path
+        self._lock = threading.Lock()
+        self._counties = None
+        self._places = None
+        self._school_districts = None
+
+    def _rows(self, fname):
+        with open(join(self.path, fname), 'rb') as f:
+            for row in csv.reader(f):
+                yield [c.decode('utf-8') for c in row]
+
+    def _load_counties(self):
+        names = set()
+        by_state = {}
+        fips = {}
+        fips_by_name = {}
+        for name, state, code in self._rows('county_names.csv'):
+            name = normalize(name)
+            names.add(name)
+            by_state.setdefault(state, set()).add(name)
+            fips[code] = (name, state)
+            fips_by_name[(name, state)] = code
+        return {
+            'names': frozenset(names),
+            'by_state': {k: frozenset(v) for k, v in by_state.items()},
+            'fips': fips,
+            'fips_by_name': fips_by_name,
+        }
+
+    def _load_places(self):
+        geoids = {}
+        short_names = {}
+        for name, state, geoid in self._rows('place_names.csv'):
+            name = normalize(name)
+            geoids[(name, state)] = geoid
+            short = PLACE_SUFFIX.sub('', name)
+            if short != name:
+                short_names.setdefault((short, state), []).append((name, geoid))
+        for key, places in short_names.items():
+            if key in geoids:
+                # a place really called that wins
+                continue
+            # "springfield" is the city rather than a CDP of the same name,
+            # but two cities (or two CDPs) leave it to the API
+            incorporated = [g for n, g in places if not n.endswith(' cdp')]
+            if len(places) == 1:
+                geoids[key] = places[0][1]
+            elif len(incorporated) == 1:
+                geoids[key] = incorporated[0]
+        return {'geoids_by_name': geoids}
+
+    def _load_school_districts(self):
+        names = set()
+        by_state = {}
+        geoids = {}
+        for row in self._rows('school_dists.csv'):
+            name, state = normalize(row[0]), row[1]
+            names.add(name)
+            by_state.setdefault(state, set()).add(name)
+            # an optional third column holds the district's geoid
+            if len(row) > 2 and row[2]:
+                geoids[(name, state)] = row[2]
+        return {
+            'names': frozenset(names),
+            'by_state': {k: frozenset(v) for k, v in by_state.items()},
+            'geoids_by_name': geoids,
+        }
+
+    @property
+    def counties(self):
+        if self._counties is None:
+            with self._lock:
+                if self._counties is None:
+                    self._counties = self._load_counties()
+        return self._counties
+
+    @property
+    def places(self):
+        if self._places is None:
+            with self._lock:
+                if self._places is None:
+                    self._places = self._load_places()
+        return self._places
+
+    @property
+    def school_districts(self):
+        if self._school_districts is None:
+            with self._lock:
+                if self._school_districts is None:
+                    self._school_districts = self._load_school_districts()
+        return self._school_districts
+
+    @property
+    def county_names(self):
+        return self.counties['names']
+
+    @property
+    def counties_by_state(self):
+        return self.counties['by_state']
+
+    @property
+    def county_fips(self):
+        return self.counties['fips']
+
+    @property
+    def county_fips_by_name(self):
+        return self.counties['fips_by_name']
+
+    @property
+    def place_geoids_by_name(self):
+        return self.places['geoids_by_name']
+
+    @property
+    def school_district_names(self):
+        return self.school_districts['names']
+
+    @property
+    def school_districts_by_state(self):
+        return self.school_districts['by_state']
+
+    @property
+    def school_district_geoids_by_name(self):
+        return self.school_districts['geoids_by_name']
+
+    def preload(self):
+        """
+        Parses every file now rather than on first use. Meant for a
+        parent process that is about to fork its workers.
+        """
+        self.counties
+        self.places
+        self.school_districts
+
+gazetteer = Gazetteer()
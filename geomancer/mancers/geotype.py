@@ -1,10 +1,7 @@
 from json import JSONEncoder
 import re
-import us
-from os.path import join, abspath, dirname
-import csv
-
-GAZDIR = join(dirname(abspath(__file__)), 'gazetteers')
+from geomancer.mancers.gazetteer import gazetteer, normalize
+from geomancer.mancers.states import state_index
 
 class GeoType(object):
     """ 
@@ -17,6 +14,11 @@ class GeoType(object):
     formatting_example = None
     validation_regex = None
 
+    def __init__(self):
+        self.pattern = None
+        if self.validation_regex is not None:
+            self.pattern = re.compile(self.validation_regex)
+
     def as_dict(self):
         fields = [
             'human_name',
@@ -47,13 +49,41 @@ class GeoType(object):
         else:
             values = list(set([v for v in values if v]))
             for v in values:
-                if not re.match(self.validation_regex, v):
+                if not self.match(v):
                     message = 'The column you selected must be formatted \
                         like "%s" to match on %s geographies. Please pick another \
                         column or change the format of your data.' % \
                         (self.formatting_example, self.human_name)
                     return False, message
             return True, None
+
+    def match(self, value):
+        '''
+        Returns whether a single value looks like this geography. The
+        default uses validation_regex; subclasses that override validate
+        should override this too.
+        '''
+        if self.pattern is None:
+            return False
+        return self.pattern.match(value) is not None
+
+    def score(self, values, min_score=0):
+        '''
+        Returns the fraction of the distinct, non-empty values that
+        match. Gives up and returns 0 as soon as min_score is out of
+        reach.
+        '''
+        values = set([v for v in values if v])
+        if not values:
+            return 0.0
+        total = float(len(values))
+        missed = 0
+        for v in values:
+            if not self.match(v):
+                missed += 1
+                if (total - missed) / total < min_score:
+                    return 0.0
+        return (total - missed) / total
       
 class GeoTypeEncoder(JSONEncoder):
     ''' 
@@ -62,6 +92,34 @@ class GeoTypeEncoder(JSONEncoder):
     def default(self, o):
         return o.as_dict()
 
+def split_state(value):
+    '''
+    Splits a value like "Cook County, IL" into its normalized name and
+    the postal abbreviation of its state. The abbreviation is None when
+    there is no trailing state or it is not one we recognize.
+    '''
+    name, _, state = value.rpartition(',')
+    if name:
+        st = state_index.lookup(state)
+        if st:
+            return normalize(name), st.abbr
+    return normalize(value), None
+
+def check_names(values, names, names_by_state):
+    '''
+    Returns the values that do not appear in the gazetteer. Values that
+    name a state are only checked against the names in that state.
+    '''
+    diffs = set()
+    for val in values:
+        name, state = val
+        if state:
+            if name not in names_by_state.get(state, ()):
+                diffs.add(name)
+        elif name not in names:
+            diffs.add(name)
+    return diffs
+
 class City(GeoType):
     human_name = 'City'
     machine_name = 'city'
@@ -69,39 +127,18 @@ class City(GeoType):
         AP abbreviation.' 
     formatting_example = 'Chicago, Illinois; Chicago, IL or Chicago, Ill.'
 
-   #def validate(self, values):
-   #    ''' 
-   #    Uses the US Census 2014 Place Name Gazetteer.
-   #    https://www.census.gov/geo/maps-data/data/gazetteer2014.html
-   #    '''
-   #    gazetteer = set()
-   #    with open(join(GAZDIR, 'place_names.csv'), 'rb') as f:
-   #        reader = csv.reader(f)
-   #        for row in reader:
-   #            gazetteer.add(row[0].lower())
-   #    values = set([v.split(',')[0].lower() for v in values if v])
-   #    if values <= gazetteer:
-   #        return True, None
-   #    else:
-   #        diffs = values - gazetteer
-   #        return False, '"{0}" do not appear to be valid Census places'\
-   #            .format(', '.join(diffs))
-
 class State(GeoType):
     human_name = 'State'
     machine_name = 'state'
     formatting_notes = 'State name, postal abbreviation, or AP abbreviation.'
     formatting_example = 'Illinois, IL or Ill.'
     
+    def match(self, value):
+        return state_index.lookup(value) is not None
+
     def validate(self, values):
-        values = [v for v in values if v]
-        non_matches = set()
-        for val in values:
-            st = us.states.lookup(val)
-            if not st:
-                st = [s for s in us.STATES if getattr(s, 'ap_abbr') == val]
-            if not st:
-                non_matches.add(val)
+        found = state_index.lookup_many([v for v in values if v])
+        non_matches = [v for v, st in found.items() if st is None]
         if non_matches:
             return False, '"{0}" do not appear to be valid Census places'\
                 .format(', '.join(non_matches))
@@ -119,24 +156,25 @@ class County(GeoType):
         Uses the US Census 2014 County Gazetteer.
         https://www.census.gov/geo/maps-data/data/gazetteer2014.html
         '''
-        gazetteer = set()
-        with open(join(GAZDIR, 'county_names.csv'), 'rb') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                gazetteer.add(row[0].lower())
-        vals = set()
-        for val in values:
-            val = val.lower()
-            if 'county' not in val:
-                val = u'{0} county'.format(val)
-            vals.add(val)
-        if vals <= gazetteer:
+        vals = set([self._name(v) for v in values if v])
+        diffs = check_names(vals, gazetteer.county_names, 
+                            gazetteer.counties_by_state)
+        if not diffs:
             return True, None
         else:
-            diffs = vals - gazetteer
             return False, u'"{0}" do not appear to be valid Counties'\
                 .format(u', '.join(diffs))
 
+    def _name(self, value):
+        name, state = split_state(value)
+        if 'county' not in name:
+            name = u'{0} county'.format(name)
+        return name, state
+
+    def match(self, value):
+        return not check_names([self._name(value)], gazetteer.county_names, 
+                               gazetteer.counties_by_state)
+
 class SchoolDistrict(GeoType):
     human_name = 'School district'
     machine_name = 'school_district'
@@ -149,19 +187,26 @@ class SchoolDistrict(GeoType):
         School District Gazetteers.
         https://www.census.gov/geo/maps-data/data/gazetteer2014.html
         '''
-        gazetteer = set()
-        with open(join(GAZDIR,'school_dists.csv'), 'rb') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                gazetteer.add(row[0].lower())
-        values = set([v.split(',')[0].lower() for v in values if v])
-        if values <= gazetteer:
+        vals = set([self._name(v) for v in values if v])
+        diffs = check_names(vals, gazetteer.school_district_names, 
+                            gazetteer.school_districts_by_state)
+        if not diffs:
             return True, None
         else:
-            diffs = values - gazetteer
             return False, u'"{0}" do not appear to be valid School Districts'\
                 .format(u', '.join(diffs))
 
+    def _name(self, value):
+        name, state = split_state(value)
+        if state is None:
+            name = normalize(value.split(',')[0])
+        return name, state
+
+    def match(self, value):
+        return not check_names([self._name(value)], 
+                               gazetteer.school_district_names, 
+                               gazetteer.school_districts_by_state)
+
 class CongressionalDistrict(GeoType):
     human_name = 'Congressional district'
     machine_name = 'congress_district'
@@ -191,6 +236,11 @@ class StateFIPS(GeoType):
     formatting_example = '17'
     validation_regex = r'\d{2}$'
 
+    def match(self, value):
+        # two digits isn't enough: 03, 07, 14, 43 and 52 aren't states
+        return self.pattern.match(value) is not None and \
+            state_index.lookup(value) is not None
+
 class StateCountyFIPS(GeoType):
     human_name = 'FIPS: County'
     machine_name = 'state_county_fips'
@@ -203,19 +253,17 @@ class StateCountyFIPS(GeoType):
         Uses the US Census 2014 County Gazetteers.
         https://www.census.gov/geo/maps-data/data/gazetteer2014.html
         '''
-        gazetteer = set()
-        with open(join(GAZDIR, 'county_names.csv'), 'rb') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                gazetteer.add(row[2].lower())
-        values = set([v.split(',')[0].lower() for v in values if v])
-        if values <= gazetteer:
+        values = set([v.split(',')[0].strip() for v in values if v])
+        diffs = values.difference(gazetteer.county_fips)
+        if not diffs:
             return True, None
         else:
-            diffs = values - gazetteer
             return False, u'"{0}" do not appear to be valid County FIPS codes'\
                 .format(u', '.join(diffs))
 
+    def match(self, value):
+        return value.split(',')[0].strip() in gazetteer.county_fips
+
 class CensusTract(GeoType):
     human_name = 'FIPS: Census Tract'
     machine_name = 'census_tract'
@@ -0,0 +1,330 @@
+import cPickle
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from os.path import join
+from urlparse import urlparse
+import requests
+from redis import Redis
+from redis.exceptions import WatchError
+from requests.structures import CaseInsensitiveDict
+from scrapelib.cache import FileCache
+from geomancer.app_config import CACHE_DIR
+from geomancer.cache import thread_connection
+from geomancer.config import config
+
+HTTP_CACHE_BACKEND = config('HTTP_CACHE_BACKEND', 'sqlite')
+HTTP_CACHE_PATH = config('HTTP_CACHE_PATH', join(CACHE_DIR, 'geomancer_http_cache.sqlite'))
+HTTP_CACHE_TTL = config('HTTP_CACHE_TTL', 7 * 24 * 60 * 60)
+HTTP_CACHE_TTLS = config('HTTP_CACHE_TTLS', {})
+HTTP_CACHE_MAX_SIZE = config('HTTP_CACHE_MAX_SIZE', 1024 * 1024 * 1024)
+HTTP_CACHE_LOCK_TIMEOUT = config('HTTP_CACHE_LOCK_TIMEOUT', 30)
+
+def split_url(url):
+    """
+    Returns the host and the path (with the query string) of url,
+    which is what the caches index responses by.
+    """
+    parts = urlparse(url)
+    path = parts.path
+    if parts.query:
+        path = '%s?%s' % (path, parts.query)
+    return parts.netloc, path
+
+def build_response(key, status_code, encoding, headers, content):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.encoding = encoding
+    resp.headers = CaseInsensitiveDict(headers)
+    resp._content = content
+    resp.url = key
+    return resp
+
+class FileHTTPCache(FileCache):
+    """
+    scrapelib's FileCache (one uncompressed file per URL in cache_dir,
+    never expiring) with the flush() every HTTP cache has.
+    """
+
+    def flush(self, host, path=None):
+        """
+        Removes the cached responses for host, optionally only those
+        whose path starts with path, by scanning cache_dir (which may be
+        shared with other files, so there is no flushing everything).
+        """
+        prefix = self._illegal.sub(',', host + (path or ''))
+        count = 0
+        for f in os.listdir(self.cache_dir):
+            if f.startswith(prefix):
+                os.remove(os.path.join(self.cache_dir, f))
+                count += 1
+        return count
+
+    def release_locks(self):
+        pass
+
+class SQLiteHTTPCache(object):
+    """
+    Cache storage for scrapelib that keeps every response zlib compressed
+    in one SQLite file, shared by all the mancers (and processes) on a
+    host. Entries expire after ttl seconds (None keeps them forever).
+    As soon as a write takes the compressed responses past max_size
+    bytes, the least recently used ones are dropped; triggers keep the
+    running total so checking it costs nothing. Responses are indexed by
+    host and path so flush() never scans the whole cache.
+    """
+    # how many writes go by between sweeps for expired responses
+    prune_every = 100
+    # don't bother recording a hit more often than this (in seconds)
+    touch_after = 60
+
+    def __init__(self, path=HTTP_CACHE_PATH, ttl=HTTP_CACHE_TTL,
+                 max_size=HTTP_CACHE_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._local = threading.local()
+        self._writes = 0
+
+    def _setup(self, conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS responses
+            (key text PRIMARY KEY, host text, path text, status integer,
+             encoding text, headers text, content blob, size integer,
+             expires real, last_used real)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_host_path '
+                     'ON responses (host, path)')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used '
+                     'ON responses (last_used)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS responses_size
+            (id integer PRIMARY KEY CHECK (id = 0), total integer)''')
+        conn.execute('INSERT OR IGNORE INTO responses_size '
+                     'SELECT 0, COALESCE(SUM(size), 0) FROM responses')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS responses_added
+            AFTER INSERT ON responses BEGIN
+            UPDATE responses_size SET total = total + NEW.size; END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS responses_removed
+            AFTER DELETE ON responses BEGIN
+            UPDATE responses_size SET total = total - OLD.size; END''')
+
+    @property
+    def conn(self):
+        return thread_connection(self._local, self.path, self._setup)
+
+    def total_size(self):
+        return self.conn.execute('SELECT total FROM responses_size').fetchone()[0]
+
+    def get(self, key):
+        """
+        Returns the cached response for key, or None.
+        """
+        now = time.time()
+        row = self.conn.execute(
+            'SELECT status, encoding, headers, content, last_used FROM responses '
+            'WHERE key=? AND (expires IS NULL OR expires > ?)',
+            (key.encode('utf8'), now)).fetchone()
+        if row is None:
+            return None
+        status, encoding, headers, content, last_used = row
+        if now - last_used > self.touch_after:
+            with self.conn:
+                self.conn.execute('UPDATE responses SET last_used=? WHERE key=?',
+                                  (now, key.encode('utf8')))
+        return build_response(key, status, encoding, json.loads(headers),
+                              zlib.decompress(str(content)))
+
+    def set(self, key, response):
+        now = time.time()
+        content = zlib.compress(response.content)
+        host, path = split_url(key)
+        expires = now + self.ttl if self.ttl else None
+        with self.conn:
+            # not INSERT OR REPLACE: the delete trigger has to see the old row
+            self.conn.execute('DELETE FROM responses WHERE key=?', (key.encode('utf8'),))
+            self.conn.execute('INSERT INTO responses VALUES (?,?,?,?,?,?,?,?,?,?)',
+                (key.encode('utf8'), host, path.encode('utf8'), response.status_code,
+                 response.encoding, json.dumps(dict(response.headers)),
+                 sqlite3.Binary(content), len(content), expires, now))
+        self._writes += 1
+        if self._writes % self.prune_every == 1 or \
+                (self.max_size and self.total_size() > self.max_size):
+            self.prune()
+
+    def prune(self):
+        """
+        Drops expired responses, then the least recently used ones until
+        the cache is back under 90% of max_size.
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM responses WHERE expires <= ?', (time.time(),))
+        if not self.max_size:
+            return
+        total = self.total_size()
+        target = self.max_size * 0.9
+        if total <= target:
+            return
+        stale = []
+        for key, size in self.conn.execute('SELECT key, size FROM responses '
+                                           'ORDER BY last_used'):
+            stale.append((key,))
+            total -= size
+            if total <= target:
+                break
+        with self.conn:
+            self.conn.executemany('DELETE FROM responses WHERE key=?', stale)
+
+    def flush(self, host=None, path=None):
+        """
+        Removes the cached responses for host, optionally only those
+        whose path (query string included) starts with path. With no
+        host, removes everything. Returns the number removed.
+        """
+        if host is None:
+            query, params = 'DELETE FROM responses', ()
+        elif path is None:
+            query, params = 'DELETE FROM responses WHERE host=?', (host,)
+        else:
+            # a range rather than LIKE so the index is used
+            query = 'DELETE FROM responses WHERE host=? AND path >= ? AND path < ?'
+            path = path.encode('utf8')
+            params = (host, path, path + '\xff')
+        with self.conn:
+            cursor = self.conn.execute(query, params)
+        return cursor.rowcount
+
+    def release_locks(self):
+        pass
+
+GLOB_CHARS = re.compile(r'([\\*?\[\]])')
+
+class RedisHTTPCache(object):
+    """
+    Cache storage for scrapelib that keeps responses zlib compressed in
+    Redis, so every worker and web host talking to the same Redis server
+    shares them. Entries expire after ttl seconds (None keeps them until
+    Redis evicts them; set a maxmemory policy on the server to cap it).
+
+    Misses are single-flight: the first thread (on any host) to miss a
+    URL takes a lock and returns None so that it goes and fetches it,
+    while everyone else missing the same URL waits up to lock_timeout
+    seconds for that response to show up in the cache. The lock is let
+    go when the response is stored, or by release_locks() once the
+    request is over, whichever way it went.
+    """
+    poll_interval = 0.1
+
+    def __init__(self, ttl=HTTP_CACHE_TTL, redis=None, prefix='geomancer:http:',
+                 lock_timeout=HTTP_CACHE_LOCK_TIMEOUT):
+        if redis is None:
+            redis = Redis()
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self._local = threading.local()
+
+    @property
+    def _held(self):
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        return held
+
+    def _key(self, key):
+        return '%sdata:%s' % (self.prefix, key.encode('utf8'))
+
+    def _lock_key(self, key):
+        return '%slock:%s' % (self.prefix, key.encode('utf8'))
+
+    def _load(self, key, val):
+        status_code, encoding, headers, content = cPickle.loads(zlib.decompress(val))
+        return build_response(key, status_code, encoding, headers, content)
+
+    def get(self, key):
+        """
+        Returns the cached response for key, or None when the caller
+        should fetch it (and set() it) itself.
+        """
+        val = self.redis.get(self._key(key))
+        if val is not None:
+            return self._load(key, val)
+        deadline = time.time() + self.lock_timeout
+        while True:
+            token = uuid.uuid4().hex
+            if self.redis.set(self._lock_key(key), token, nx=True,
+                              px=int(self.lock_timeout * 1000)):
+                self._held[key] = token
+                return None
+            time.sleep(self.poll_interval)
+            val = self.redis.get(self._key(key))
+            if val is not None:
+                return self._load(key, val)
+            if time.time() > deadline:
+                # whoever holds the lock is taking too long; fetch it anyway
+                return None
+
+    def set(self, key, response):
+        val = zlib.compress(cPickle.dumps((response.status_code, response.encoding,
+            dict(response.headers), response.content), protocol=-1))
+        if self.ttl:
+            self.redis.setex(self._key(key), val, int(self.ttl))
+        else:
+            self.redis.set(self._key(key), val)
+        self._release(key)
+
+    def _release(self, key):
+        token = self._held.pop(key, None)
+        if token is None:
+            return
+        lock_key = self._lock_key(key)
+        # only delete the lock if it is still ours and has not timed out
+        # and gone to someone else
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(lock_key)
+                if pipe.get(lock_key) == token:
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+            except WatchError:
+                pass
+
+    def release_locks(self):
+        """
+        Lets go of the locks the current thread took for responses it
+        never stored (because the request failed, say).
+        """
+        for key in self._held.keys():
+            self._release(key)
+
+    def flush(self, host=None, path=None):
+        """
+        Removes the cached responses for host, optionally only those
+        whose path starts with path. With no host, removes everything.
+        Returns the number removed.
+        """
+        match = '%sdata:' % self.prefix
+        if host is not None:
+            match += 'http*://' + GLOB_CHARS.sub(r'\\\1', host + (path or ''))
+        count = 0
+        for key in self.redis.scan_iter(match=match + '*'):
+            count += self.redis.delete(key)
+        return count
+
+def get_http_cache(machine_name, cache_dir=CACHE_DIR):
+    """
+    Returns the cache storage configured by HTTP_CACHE_BACKEND ('sqlite',
+    'redis' or 'file') for the mancer called machine_name, which keeps responses
+    for HTTP_CACHE_TTLS[machine_name] seconds, or HTTP_CACHE_TTL if it is
+    not listed there.
+    """
+    if HTTP_CACHE_BACKEND == 'file':
+        return FileHTTPCache(cache_dir)
+    ttl = HTTP_CACHE_TTLS.get(machine_name, HTTP_CACHE_TTL)
+    if HTTP_CACHE_BACKEND == 'redis':
+        return RedisHTTPCache(ttl=ttl)
+    return SQLiteHTTPCache(ttl=ttl)
@@ -0,0 +1,66 @@
+import time
+from redis import Redis
+from geomancer.config import config
+
+RATE_LIMITS = config('RATE_LIMITS', {})
+
+# Takes a token from the bucket in KEYS[1], which refills at ARGV[1]
+# tokens a second up to ARGV[2] tokens, as of time ARGV[3]. The token is
+# taken even when the bucket is empty, leaving it in debt, so callers
+# queue up behind each other instead of racing for the next refill.
+# Returns how many seconds the caller has to wait before using it.
+TAKE_TOKEN = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate) - 1
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+class RateLimiter(object):
+    """
+    Token buckets kept in Redis, one per mancer machine_name listed in
+    limits, so that every process on every host talking to the same Redis
+    server draws from the same budget. limits maps machine_name to
+    (requests_per_minute, burst): the bucket holds up to burst tokens and
+    refills at requests_per_minute. wait() blocks until the caller may
+    send a request; mancers that are not listed are never held up.
+
+    Time comes from the Redis server, so hosts with skewed clocks still
+    agree on how full a bucket is.
+    """
+
+    def __init__(self, limits=RATE_LIMITS, redis=None, prefix='geomancer:rate:'):
+        if redis is None:
+            redis = Redis()
+        self.redis = redis
+        self.limits = limits
+        self.prefix = prefix
+        self._take = None
+
+    def wait(self, machine_name):
+        """
+        Takes a token for machine_name, sleeping first if the bucket is
+        empty. Returns the number of seconds spent waiting.
+        """
+        if machine_name not in self.limits:
+            return 0
+        if self._take is None:
+            self._take = self.redis.register_script(TAKE_TOKEN)
+        per_minute, burst = self.limits[machine_name]
+        secs, usecs = self.redis.time()
+        delay = float(self._take(keys=[self.prefix + machine_name],
+            args=[per_minute / 60.0, burst, secs + usecs / 1000000.0]))
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+rate_limiter = RateLimiter()
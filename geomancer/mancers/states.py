@@ -0,0 +1,99 @@
+import re
+import threading
+import us
+from collections import namedtuple
+from string import punctuation
+
+StateRecord = namedtuple('StateRecord', ['name', 'abbr', 'ap_abbr', 'fips'])
+
+PUNCTUATION = re.compile('[%s]' % re.escape(punctuation))
+
+def variant_key(value):
+    """
+    Lowercases value, drops punctuation and collapses whitespace so that
+    "Ill.", "ILL" and " ill" all land on the same key.
+    """
+    return u' '.join(PUNCTUATION.sub('', value).lower().split())
+
+def normalize_state_fips(value):
+    """
+    Pads a state FIPS code back out to two digits, since spreadsheets tend
+    to drop the leading zero ("6" for California's "06").
+    """
+    return value.zfill(2)
+
+class StateIndex(object):
+    """
+    Maps every spelling of a state we accept to a StateRecord carrying
+    all of its id forms. Built once from the us package:
+
+      name          Illinois
+      abbr          IL
+      ap_abbr       Ill.
+      fips          17
+
+    all matched regardless of case, punctuation and spacing. Anything
+    else goes through us.states.lookup, which also catches phonetic
+    misspellings, and the answer (hit or miss) is remembered, up to
+    max_fuzzy terms.
+    """
+
+    def __init__(self, states=None, max_fuzzy=10000):
+        if states is None:
+            states = us.STATES_AND_TERRITORIES
+        self.max_fuzzy = max_fuzzy
+        self._lock = threading.Lock()
+        self._fuzzy = {}
+        self._index = {}
+        self.records = []
+        for s in states:
+            rec = StateRecord(s.name, s.abbr, s.ap_abbr, s.fips)
+            self.records.append(rec)
+            for v in (s.name, s.abbr, s.ap_abbr, s.fips):
+                if v:
+                    self._index.setdefault(variant_key(unicode(v)), rec)
+
+    def _fuzzy_lookup(self, value):
+        try:
+            return self._fuzzy[value]
+        except KeyError:
+            pass
+        st = None
+        if value.strip():
+            st = us.states.lookup(value.strip())
+        rec = self._index.get(variant_key(st.name)) if st else None
+        with self._lock:
+            if len(self._fuzzy) >= self.max_fuzzy:
+                self._fuzzy.clear()
+            self._fuzzy[value] = rec
+        return rec
+
+    def lookup(self, value):
+        """
+        Returns the StateRecord for value, or None.
+        """
+        if not value:
+            return None
+        rec = self._index.get(variant_key(value))
+        if rec is None:
+            rec = self._fuzzy_lookup(value)
+        return rec
+
+    def lookup_many(self, values):
+        """
+        Returns a dict mapping each distinct value to its StateRecord
+        (or None).
+        """
+        return {v: self.lookup(v) for v in set(values)}
+
+state_index = StateIndex()
+
+def lookup_state(term, attr='name'):
+    """
+    Returns the given attribute ('name', 'abbr', 'ap_abbr' or 'fips') of
+    the state term refers to, or term itself when it is not a state.
+    """
+    rec = state_index.lookup(term)
+    if rec is None:
+        return term
+    return getattr(rec, attr)
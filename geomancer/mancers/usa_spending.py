@@ -1,13 +1,14 @@
 import scrapelib
-import us
 from urllib import urlencode
 import json
 import os
 from geomancer.mancers.base import BaseMancer
+from geomancer.mancers.states import state_index, lookup_state
 from geomancer.mancers.geotype import City, State, Zip5, County, \
     CongressionalDistrict
 from geomancer.helpers import encoded_dict
 from lxml import etree
+from io import BytesIO
 import re
 from collections import OrderedDict
 from datetime import datetime
@@ -30,6 +31,9 @@ TABLE_PARAMS = {
     },
 }
 
+def localname(elem):
+    return etree.QName(elem).localname
+
 class USASpending(BaseMancer):
     """ 
     Subclassing BaseMancer
@@ -88,84 +92,94 @@ class USASpending(BaseMancer):
         return datasets
 
     def fetch_xml(self, url, params):
+        """
+        Returns an OrderedDict of the values in the first record of the
+        response, sorted by column name. The XML is parsed incrementally
+        and each table is thrown away as soon as its values are read,
+        so big responses are never held as a whole tree; parsing stops
+        at the end of the first record.
+        """
         table = OrderedDict()
         response = self.urlopen('%s?%s' % (url, params))
-        tree = etree.fromstring(str(response))
-        xml_schema = tree.nsmap[None]
-        tables = tree\
-            .find('{%s}data' % xml_schema)\
-            .find('{%s}record' % xml_schema)\
-            .getchildren()
-        for t in tables:
-            table_name = t.tag.replace('{%s}' % xml_schema, '')
-            child_nodes = t.getchildren()
-            for column in child_nodes:
-                key = column.tag.replace('{%s}' % xml_schema, '')
-                value = column.text
-                if column.attrib:
-                    for k,v in column.attrib.items():
-                        if k in ['rank', 'year']:
-                            header_val = '%s_%s_%s' % (table_name,k,v.zfill(2))
-                            table[header_val] = value
-                        if k in ['total_obligatedAmount', 'id', 'name']: 
-                            rank = column.attrib['rank']
-                            header_val = '%s_rank_%s_%s' % (table_name,rank.zfill(2),k)
-                            table[header_val] = v
-                else:
-                    header_val = '%s_%s' % (table_name,key)
-                    table[header_val] = value
+        path = []
+        for event, elem in etree.iterparse(BytesIO(response.bytes), 
+                                           events=('start', 'end')):
+            if event == 'start':
+                path.append(localname(elem))
+                continue
+            path.pop()
+            if path[1:] == ['data', 'record']:
+                table_name = localname(elem)
+                for column in elem:
+                    key = localname(column)
+                    value = column.text
+                    if column.attrib:
+                        for k,v in column.attrib.items():
+                            if k in ['rank', 'year']:
+                                header_val = '%s_%s_%s' % (table_name,k,v.zfill(2))
+                                table[header_val] = value
+                            if k in ['total_obligatedAmount', 'id', 'name']: 
+                                rank = column.attrib['rank']
+                                header_val = '%s_rank_%s_%s' % (table_name,rank.zfill(2),k)
+                                table[header_val] = v
+                    else:
+                        header_val = '%s_%s' % (table_name,key)
+                        table[header_val] = value
+                elem.clear()
+            elif path[1:] == ['data'] and localname(elem) == 'record':
+                break
         return OrderedDict(sorted(table.items()))
 
-    def lookup_state(self, term):
-        st = us.states.lookup(term)
-        if not st:
-            st = [s for s in us.STATES if getattr(s, 'ap_abbr') == term]
-        if st:
-            return st.abbr
-        else:
-            return term
-
     def geo_lookup(self, search_term, geo_type=None):
+        return {'term': search_term, 
+                'geoid': self.geo_lookup_many([search_term], geo_type)[search_term]}
+
+    def geo_lookup_many(self, terms, geo_type=None):
+        terms = set(terms)
         if geo_type == 'state':
-            return {'term': search_term, 'geoid': self.lookup_state(search_term)}
+            states = state_index.lookup_many(terms)
+            return {t: states[t].abbr if states[t] else t for t in terms}
         elif geo_type == 'congress_district':
-            parts = search_term.split(' ')
-            district = search_term
-            if len(parts) > 1:
-                st_abbr = self.lookup_state(parts[0])
-                dist_code = parts[1].zfill(2)
-                district = st_abbr + dist_code 
-            return {'term': search_term, 'geoid': district}
+            geoids = {}
+            for term in terms:
+                parts = term.split(' ')
+                district = term
+                if len(parts) > 1:
+                    st_abbr = lookup_state(parts[0], attr='abbr')
+                    dist_code = parts[1].zfill(2)
+                    district = st_abbr + dist_code 
+                geoids[term] = district
+            return geoids
         else:
-            return {'term': search_term, 'geoid': search_term.zfill(5)}
+            return {t: t.zfill(5) for t in terms}
 
     def search(self, geo_ids=None, columns=None):
-        result = {'header': []}
+        """
+        Fetches every (geoid, table) pair concurrently (see
+        concurrent_map) and lines the values up under the union of the
+        column names, in the order they first show up.
+        """
+        def fetch(request):
+            geo_type, geo_id, col = request
+            url = '%s/%s/%s.php' % (self.base_url, col, col)
+            param = TABLE_PARAMS[col][geo_type]
+            query = {param: geo_id, 'detail': 's'}
+            params = urlencode(query)
+            return self.fetch_xml(url, params)
+
+        requests = [(geo_type, geo_id, col) for geo_type, geo_id in geo_ids \
+                    for col in columns]
+        tables = self.concurrent_map(fetch, requests)
+
+        header = OrderedDict()
         table_ds = {}
+        for (geo_type, geo_id, col), table in zip(requests, tables):
+            for key in table:
+                header[key] = None
+            table_ds.setdefault(geo_id, {}).update(table)
+
+        result = {'header': [' '.join(c.split('_')).title() for c in header]}
         for geo_type, geo_id in geo_ids:
-            result[geo_id] = []
-            for col in columns:
-                url = '%s/%s/%s.php' % (self.base_url, col, col)
-                param = TABLE_PARAMS[col][geo_type]
-                query = {param: geo_id, 'detail': 's'}
-                params = urlencode(query)
-                table = self.fetch_xml(url, params)
-                if not result['header']:
-                    result['header'] = table.keys()
-                else:
-                    diff = set(table.keys()).difference(set(result['header']))
-                    positions = [(i,c,) for i,c in enumerate(table.keys()) if c in diff]
-                    for idx, col in positions:
-                        result['header'].insert(idx,col)
-                table_ds[geo_id] = table
-        for geo_type, geo_id in geo_ids:
-            d = OrderedDict()
-            for key in result['header']:
-                try:
-                    d[key] = table_ds[geo_id][key]
-                except KeyError:
-                    d[key] = ''
-            result[geo_id] = d.values()
-        result['header'] = [' '.join(c.split('_')).title() for c in result['header']]
+            values = table_ds.get(geo_id, {})
+            result[geo_id] = [values.get(key, '') for key in header]
         return result
-    
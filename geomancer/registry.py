@@ -0,0 +1,263 @@
+import os
+import json
+import hashlib
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from geomancer.app_config import MANCERS, MANCER_KEYS
+from geomancer.mancers.geotype import GeoTypeEncoder
+from geomancer.config import config
+
+METADATA_TTL = config('METADATA_TTL', 60 * 60)
+
+class MancerRegistry(object):
+    """
+    Builds an instance of every mancer listed in MANCERS, along with the
+    result of its get_metadata(), once per process. A background thread
+    rebuilds everything every ttl seconds and swaps the new copy in, so
+    callers only ever pay for a dictionary lookup.
+
+    Forked children keep the parent's copy (copy-on-write) but drop any
+    HTTP connections the parent opened and start their own refresh thread.
+    """
+
+    def __init__(self, mancers=MANCERS, ttl=METADATA_TTL):
+        self.mancer_paths = mancers
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._state = None
+        self._built_pid = None
+        self._pid = None
+
+    def _build(self):
+        from geomancer.helpers import import_class
+        mancers = OrderedDict()
+        metadata = OrderedDict()
+        errors = []
+        for path in self.mancer_paths:
+            m = import_class(path)
+            api_key = MANCER_KEYS.get(m.machine_name)
+            try:
+                m = m(api_key=api_key)
+            except ImportError, e:
+                errors.append(e.message)
+                continue
+            mancers[m.machine_name] = m
+            metadata[m.machine_name] = m.get_metadata()
+        index = MetadataIndex(mancers, metadata, errors)
+        return {'mancers': mancers, 'metadata': metadata, 'errors': errors, 
+                'index': index}
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self._state = self._build()
+            except Exception:
+                # keep serving the metadata we have until the next try
+                traceback.print_exc()
+
+    def preload(self):
+        """
+        Builds everything without starting the refresh thread. Meant for
+        a parent process that is about to fork its workers. If a mancer
+        can't be built (its upstream is down, say) the error is printed
+        and the children build everything themselves on first use.
+        """
+        with self._lock:
+            if self._state is None:
+                try:
+                    self._state = self._build()
+                except Exception:
+                    traceback.print_exc()
+                    return
+                self._built_pid = os.getpid()
+
+    def load(self):
+        """
+        Returns the current state, building it and starting the refresh
+        thread on first use in this process. Called by every accessor;
+        cheap once loaded.
+        """
+        if self._state is not None and self._pid == os.getpid():
+            return self._state
+        with self._lock:
+            if self._state is None:
+                self._state = self._build()
+                self._built_pid = os.getpid()
+            elif self._built_pid != os.getpid():
+                # forked: leave the parent's HTTP connections alone
+                for m in self._state['mancers'].values():
+                    m.close()
+                self._built_pid = os.getpid()
+            if self._pid != os.getpid():
+                if self.ttl:
+                    t = threading.Thread(target=self._refresh_forever)
+                    t.daemon = True
+                    t.start()
+                self._pid = os.getpid()
+        return self._state
+
+    def mancers(self):
+        """
+        OrderedDict of mancer instances keyed by machine_name
+        """
+        return self.load()['mancers']
+
+    def metadata(self, machine_name=None):
+        """
+        The get_metadata() list for one mancer, or an OrderedDict of
+        them keyed by machine_name. Shared by every caller, so treat
+        it as read-only.
+        """
+        metadata = self.load()['metadata']
+        if machine_name:
+            return metadata[machine_name]
+        return metadata
+
+    def errors(self):
+        """
+        Messages for the mancers that could not be loaded
+        """
+        return self.load()['errors']
+
+    def index(self):
+        """
+        The MetadataIndex built from the current metadata
+        """
+        return self.load()['index']
+
+class MetadataIndex(object):
+    """
+    Lookups precomputed from the mancers' metadata every time it is
+    (re)loaded:
+
+      geo_type -> tables that can be joined on it
+      table_id -> the mancer offering it and its columns
+      mancer machine_name -> its tables
+
+    along with the finished responses for the /geographies and
+    /data-sources pages and the JSON bodies (with ETags) for the API.
+    Everything handed out is shared between requests; treat it as
+    read-only.
+    """
+
+    def __init__(self, mancers, metadata, errors):
+        self.errors = tuple(errors)
+        self.tables = OrderedDict()
+        self.mancer_tables = OrderedDict()
+        self.geo_type_tables = {}
+        geo_types = {}
+        for machine_name, cols in metadata.items():
+            m = mancers[machine_name]
+            cols = sorted(cols, key=lambda c: c['human_name'])
+            self.mancer_tables[machine_name] = tuple([c['table_id'] for c in cols])
+            for col in cols:
+                self.tables[col['table_id']] = {'mancer': m, 'table': col}
+                for t in col['geo_types']:
+                    geo_types.setdefault(t.machine_name, t)
+                    self.geo_type_tables.setdefault(t.machine_name, [])\
+                        .append(col['table_id'])
+        for geo_type, table_ids in self.geo_type_tables.items():
+            table_ids = sorted(set(table_ids), 
+                key=lambda t: self.tables[t]['table']['human_name'])
+            self.geo_type_tables[geo_type] = tuple(table_ids)
+
+        self._geo_types = {}
+        for machine_name, t in geo_types.items():
+            tables = [self.tables[table_id]['table'] \
+                      for table_id in self.geo_type_tables[machine_name]]
+            self._geo_types[machine_name] = {
+                'info': t,
+                'tables': [{'human_name': c['human_name'], 
+                            'table_id': c['table_id'], 
+                            'source_name': c['source_name'], 
+                            'count': c['count'], 
+                            'source_url': c['source_url']} for c in tables],
+            }
+        self._all_geo_types = sorted(self._geo_types.values(), 
+                                     key=lambda x: x['info'].human_name)
+
+        self._data_sources = {None: self._build_data_sources(mancers)}
+        for geo_type in self.geo_type_tables.keys():
+            self._data_sources[geo_type] = self._build_data_sources(mancers, geo_type)
+
+        self._table_info = OrderedDict()
+        for table_id, entry in self.tables.items():
+            col = entry['table']
+            self._table_info[table_id] = {
+              'table_id': col['table_id'],
+              'human_name': col['human_name'],
+              'mancer': entry['mancer'].name, 
+              'columns': col['columns'],
+              'source_url': col['source_url'],
+            }
+
+        self._json = {}
+        self._set_json('geo_types', None, self._all_geo_types)
+        for geo_type, info in self._geo_types.items():
+            self._set_json('geo_types', geo_type, [info])
+        for geo_type, sources in self._data_sources.items():
+            self._set_json('data_sources', geo_type, sources)
+        self._set_json('table_info', None, self._table_info.values())
+        for table_id, info in self._table_info.items():
+            self._set_json('table_info', table_id, [info])
+
+    def _build_data_sources(self, mancers, geo_type=None):
+        mancer_data = []
+        for machine_name, table_ids in self.mancer_tables.items():
+            m = mancers[machine_name]
+            if geo_type:
+                table_ids = [t for t in table_ids \
+                             if t in self.geo_type_tables[geo_type]]
+            data_types = []
+            for table_id in table_ids:
+                col = dict(self.tables[table_id]['table'])
+                col['geo_types'] = sorted(col['geo_types'], key=lambda x: x.human_name)
+                data_types.append(col)
+            if data_types:
+                mancer_data.append({
+                    "name": m.name, 
+                    "machine_name": m.machine_name, 
+                    "base_url": m.base_url, 
+                    "info_url": m.info_url, 
+                    "description": m.description, 
+                    "data_types": data_types,
+                })
+        return mancer_data
+
+    def _set_json(self, kind, key, obj):
+        body = json.dumps(obj, cls=GeoTypeEncoder)
+        self._json[(kind, key)] = (body, hashlib.md5(body).hexdigest())
+
+    def geo_types(self, geo_type=None):
+        """
+        Geo types with the tables that can be joined on them, sorted by
+        name. Raises a KeyError for an unknown geo_type.
+        """
+        if geo_type:
+            return [self._geo_types[geo_type]]
+        return self._all_geo_types
+
+    def data_sources(self, geo_type=None):
+        """
+        Mancers with the tables they offer, optionally limited to the
+        tables that can be joined on geo_type.
+        """
+        return self._data_sources.get(geo_type, [])
+
+    def table_info(self, table_id=None):
+        if table_id:
+            return self._table_info[table_id]
+        return self._table_info.values()
+
+    def json(self, kind, key=None):
+        """
+        Returns the pre-serialized JSON body and its ETag for one of the
+        'geo_types', 'data_sources' or 'table_info' API responses, or
+        None if there is nothing precomputed for key.
+        """
+        return self._json.get((kind, key))
+
+registry = MancerRegistry()
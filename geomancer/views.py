@@ -15,10 +15,13 @@ from geomancer.helpers import import_class, get_geo_types, get_data_sources, \
     guess_geotype, check_combos, SENSICAL_TYPES
 from geomancer.app_config import ALLOWED_EXTENSIONS, \
     MAX_CONTENT_LENGTH
+from geomancer.blob_store import get_blob_store
 from werkzeug.exceptions import RequestEntityTooLarge
 
 views = Blueprint('views', __name__)
 
+blob_store = get_blob_store()
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
@@ -100,8 +103,7 @@ def upload():
                         sample_data.append((index, header_val, columns[index]))
                     session['sample_data'] = sample_data
                     session['guesses'] = json.dumps(guesses)
-                    outp.seek(0)
-                    session['file'] = outp.getvalue()
+                    session['file_key'] = blob_store.put(converted)
                     session['filename'] = f.filename
                     return redirect(url_for('views.select_geo'))
             else:
@@ -109,18 +111,23 @@ def upload():
         else:
             context['errors'] = ['You must provide a file to upload.']
             if big_file:
-                context['errors'] = ['Uploaded file must be 10mb or less.'] 
+                context['errors'] = ['Uploaded file must be %smb or less.' % \
+                    (MAX_CONTENT_LENGTH / (1024 * 1024))]
     return render_template('upload.html', **context)
 
 @views.route('/select-geography/', methods=['GET', 'POST'])
 def select_geo():
-    if not session.get('file'):
+    if not session.get('file_key'):
         return redirect(url_for('views.index'))
     context = {}
     if request.method == 'POST':
-        inp = StringIO(session['file'])
+        try:
+            inp = blob_store.open(session['file_key'])
+        except KeyError:
+            return redirect(url_for('views.index'))
         reader = UnicodeCSVReader(inp)
         header = reader.next()
+        inp.close()
         fields = {}
         valid = True
         geotype_val = None
@@ -169,7 +176,7 @@ def select_geo():
 
 @views.route('/select-tables/', methods=['POST', 'GET'])
 def select_tables():
-    if not session.get('file'):
+    if not session.get('file_key'):
         return redirect(url_for('views.index'))
     context = {}
     if request.method == 'POST' and not request.form:
@@ -5,17 +5,25 @@ from uuid import uuid4
 import sys
 import os
 import re
+import time
+import errno
+import signal
 from cStringIO import StringIO
 from csvkit.unicsv import UnicodeCSVReader, UnicodeCSVWriter
 from geomancer.mancers.base import MancerError
-from geomancer.helpers import import_class, find_geo_type, get_geo_types
-from geomancer.app_config import RESULT_FOLDER, MANCERS, MANCER_KEYS
+from geomancer.mancers.gazetteer import gazetteer
+from geomancer.cache import GeoLookupCache
+from geomancer.blob_store import get_blob_store, BLOB_TTL
+from geomancer.writers import get_writer
+from geomancer.helpers import find_geo_type
+from geomancer.registry import registry
+from geomancer.app_config import RESULT_FOLDER
 from datetime import datetime
-import xlwt
-from openpyxl import Workbook
-from openpyxl.cell import get_column_letter
 from itertools import izip_longest
+from collections import OrderedDict
+from contextlib import closing
 import traceback
+from geomancer.config import config
 
 redis = Redis()
 
@@ -28,6 +36,15 @@ except ImportError:
 except KeyError:
     client = None
 
+WORKER_PROCESSES = config('WORKER_PROCESSES', 4)
+SHARD_ROWS = config('SHARD_ROWS', 10000)
+
+# seconds a finished job's result is kept around for polling
+RESULT_TTL = 500
+
+geo_lookup_cache = GeoLookupCache()
+blob_store = get_blob_store()
+
 class DelayedResult(object):
     def __init__(self, key):
         self.key = key
@@ -40,19 +57,63 @@ class DelayedResult(object):
             if rv is not None:
                 self._rv = loads(rv)
         return self._rv
+
+    @property
+    def progress(self):
+        """
+        For jobs that were split into shards, a dict with the number of
+        shards and how many of them are done. None for other jobs.
+        """
+        meta = redis.get('%s:meta' % self.key)
+        if meta is None:
+            return None
+        return {
+            'shards': loads(meta)['num_shards'],
+            'shards_done': int(redis.get('%s:done' % self.key) or 0),
+        }
     
+def result_key():
+    qkey = current_app.config['REDIS_QUEUE_KEY']
+    return '%s:result:%s' % (qkey, str(uuid4()))
+
 def queuefunc(f):
     def delay(*args, **kwargs):
-        qkey = current_app.config['REDIS_QUEUE_KEY']
-        key = '%s:result:%s' % (qkey, str(uuid4()))
+        key = result_key()
         s = dumps((f, key, args, kwargs))
         redis.rpush(current_app.config['REDIS_QUEUE_KEY'], s)
         return DelayedResult(key)
+    def enqueue(*args, **kwargs):
+        # for jobs that store their results themselves: nothing is
+        # written under a result key of their own
+        s = dumps((f, None, args, kwargs))
+        redis.rpush(current_app.config['REDIS_QUEUE_KEY'], s)
     f.delay = delay
+    f.enqueue = enqueue
     return f
 
+def lookup_geoids(mancer, vals, geo_type):
+    """
+      Resolve the distinct non-blank values in vals to geoids and return
+      a dict mapping each of them to its geoid (or None when nothing matched).
+
+      Values already in geo_lookup_cache are not looked up again. The rest
+      go to mancer.geo_lookup_many in one call, and the results (misses
+      included) are written back to the cache. A MancerError raised by
+      the lookup is re-raised here.
+    """
+    terms = [val for val in OrderedDict.fromkeys(vals) if val]
+    geoids = geo_lookup_cache.get_many(mancer.machine_name, geo_type, terms)
+    misses = [term for term in terms if term not in geoids]
+    found = {}
+    if misses:
+        found = mancer.geo_lookup_many(misses, geo_type=geo_type)
+        found = {term: found.get(term) for term in misses}
+    geo_lookup_cache.set_many(mancer.machine_name, geo_type, found)
+    geoids.update(found)
+    return geoids
+
 @queuefunc
-def do_the_work(file_contents, field_defs, filename):
+def do_the_work(file_key, field_defs, filename):
     """
       field_defs looks like:
       {
@@ -73,177 +134,440 @@ def do_the_work(file_contents, field_defs, filename):
 
       where the semicolon separated values represent a multicolumn geography
 
-      file_contents is a string containing the contents of the uploaded file.
+      file_key is the key of the uploaded file in the blob store.
+    """
+    fname, fpath = output_path(filename)
+    with closing(blob_store.open(file_key)) as contents:
+        response = geomance(contents, field_defs, 
+                            lambda rows: write_output(fpath, rows))
+    if isinstance(response, dict):
+        response['download_url'] = '/download/%s' % fname
+    return response
+
+def geomance(contents, field_defs, write_rows, allow_empty=False):
+    """
+      Joins the rows in the file object contents with the tables listed
+      in field_defs and hands the output rows, header first, to write_rows
+      as an iterable.
+
+      The file is read twice. The first pass only collects the distinct
+      geography values so they can be resolved and searched; the second
+      pass streams each row through the join straight into write_rows,
+      so memory is bounded by the number of distinct geographies
+      rather than the number of rows.
+
+      Raises a MancerError when no geographies matched, unless allow_empty
+      is set. If a geography lookup fails, the error message is returned
+      instead of the response dict.
     """
-    contents = StringIO(file_contents)
-    reader = UnicodeCSVReader(contents)
-    header = reader.next()
-    result = None
-    geo_ids = set()
-    mancer_mapper = {}
     fields_key = field_defs.keys()[0]
-    errors = []
+    mancer_mapper = OrderedDict()
+    errors = registry.errors()[:]
 
     geo_type, col_idxs, val_fmt = find_geo_type(field_defs[fields_key]['type'], 
                                        fields_key)
-    geo_name = get_geo_types(geo_type=geo_type)[0][0]['info'].human_name
-    for mancer in MANCERS:
-        m = import_class(mancer)
-        api_key = MANCER_KEYS.get(m.machine_name)
-        try:
-            m = m(api_key=api_key)
-        except ImportError, e:
-            errors.append(e.message)
-            continue
-        mancer_cols = [c['table_id'] for c in m.get_metadata()]
+    index = registry.index()
+    geo_name = index.geo_types(geo_type)[0]['info'].human_name
+    for machine_name in index.mancer_tables.keys():
         for k, v in field_defs.items():
             field_cols = v['append_columns']
             for f in field_cols:
-                if f in mancer_cols:
+                table = index.tables.get(f)
+                if table and table['mancer'].machine_name == machine_name:
                     mancer_mapper[f] = {
-                        'mancer': m,
-                        'geo_id_map': {},
-                        'geo_ids': set(),
-                        'geo_type': geo_type,
+                        'mancer': table['mancer'],
+                        'geoids': {},
+                        'header': [],
+                        'data': {},
                     }
-    for row_idx, row in enumerate(reader):
+
+    def row_value(row):
         vals = [re.sub(r'(?i)county', '', unicode(row[int(i)])).strip() \
                 for i in col_idxs]
-        val = val_fmt.format(*vals)
-        for column in field_cols:
-            mancer = mancer_mapper[column]['mancer']
-            try:
-                if val:
-                    geoid_search = mancer.geo_lookup(val, geo_type=geo_type)
-                else:
-                    continue
-            except MancerError, e:
-                return 'Error message: %s, Body: %s' % (e.message, e.body)
-            row_geoid = geoid_search['geoid']
-            if row_geoid:
-                mancer_mapper[column]['geo_ids'].add(row_geoid)
-                try:
-                    mancer_mapper[column]['geo_id_map'][row_geoid].append(row_idx)
-                except KeyError:
-                    mancer_mapper[column]['geo_id_map'][row_geoid] = [row_idx]
-    all_data = {'header': []}
-    contents.seek(0)
-    all_rows = list(reader)
-    included_idxs = set()
-    header_row = all_rows.pop(0)
-    output = [[] for i in range(len(all_rows) + 1)]
+        return val_fmt.format(*vals)
+
+    # First pass: only keep the distinct geography values around
+    reader = iter_rows(contents)
+    header_row = reader.next()
+    distinct_vals = OrderedDict()
+    num_rows = 0
+    for row in reader:
+        distinct_vals[row_value(row)] = None
+        num_rows += 1
+
+    for column, defs in mancer_mapper.items():
+        mancer = defs['mancer']
+        try:
+            defs['geoids'] = lookup_geoids(mancer, distinct_vals.keys(), geo_type)
+        except MancerError, e:
+            return 'Error message: %s, Body: %s' % (e.message, e.body)
+        geo_ids = set([g for g in defs['geoids'].values() if g])
+        if not geo_ids:
+            if allow_empty:
+                continue
+            raise MancerError('No geographies matched')
+        try:
+            gids = [(geo_type, g,) for g in geo_ids]
+            data = mancer.search(geo_ids=gids, columns=[column])
+        except MancerError, e:
+            if client:
+                client.captureException()
+            raise e
+        defs['header'] = ['{0} ({1})'.format(h, geo_name) for h in data['header']]
+        defs['data'] = {gid: data[gid] for gid in geo_ids if gid in data}
+    del distinct_vals
+
+    output_header = header_row[:]
+    for defs in mancer_mapper.values():
+        output_header.extend(defs['header'])
 
     response = {
         'download_url': None,
         'geo_col': field_defs.values()[0]['type'],
-        'num_rows': len(all_rows),
+        'num_rows': num_rows,
         'num_matches': 0,
         'num_missing': 0,
-        'cols_added': header_row[:],
+        'cols_added': list(set(output_header) - set(header_row)),
         'errors': errors,
     }
 
-    for column, defs in mancer_mapper.items():
-        geo_ids = defs['geo_ids']
-        all_data.update({gid:[] for gid in geo_ids})
-        geoid_mapper = defs['geo_id_map']
-        geo_type = defs['geo_type']
-        if geo_ids:
-            mancer = defs['mancer']
-            try:
-                gids = [(geo_type, g,) for g in list(geo_ids)]
-                data = mancer.search(geo_ids=gids, columns=[column])
-            except MancerError, e:
-                if client:
-                    client.captureException()
-                raise e
-            header_vals = ['{0} ({1})'.format(h, geo_name) for h in data['header']]
-            all_data['header'].extend(header_vals)
-            for gid in geo_ids:
+    def joined_rows():
+        # Second pass: stream every row through the join
+        yield output_header
+        reader = iter_rows(contents)
+        reader.next()
+        for row in reader:
+            val = row_value(row)
+            row.extend([''] * (len(header_row) - len(row)))
+            matched = False
+            for defs in mancer_mapper.values():
+                geoid = defs['geoids'].get(val)
+                if geoid:
+                    matched = True
                 try:
-                    all_data[gid].extend(data[gid])
+                    row.extend(defs['data'][geoid])
                 except KeyError:
-                    all_data[gid].extend(['' for i in data.values()[0]])
-        else:
-            raise MancerError('No geographies matched')
-        for col in all_data['header']:
-            if col not in header_row:
-                header_row.append(col)
-        for geoid, row_ids in geoid_mapper.items():
-            for row_id in row_ids:
-                included_idxs.add(row_id)
-                row = all_rows[row_id]
-                row.extend(all_data[geoid])
-                output[row_id] = row
-        output.insert(0, header_row)
-    all_row_idxs = set(list(range(len(all_rows))))
-    missing_rows = all_row_idxs.difference(included_idxs)
-    for idx in sorted(missing_rows):
-        row = all_rows[idx]
-        diff = len(output[0]) - len(row)
-        row.extend(['' for i in range(diff)])
-        output[idx] = row
-    response['num_missing'] = len(missing_rows) # store away missing rows
+                    row.extend([''] * len(defs['header']))
+            if not matched:
+                response['num_missing'] += 1
+            yield row
+
+    write_rows(joined_rows())
+    response['num_matches'] = response['num_rows'] - response['num_missing']
+    return response
+
+def enqueue_work(file_key, field_defs, filename):
+    """
+      Queues the upload stored under file_key for geomancing and returns
+      a DelayedResult for it. The upload is not read here; do_the_split
+      looks at it on a worker.
+    """
+    key = result_key()
+    do_the_split.enqueue(key, file_key, field_defs, filename)
+    return DelayedResult(key)
+
+@queuefunc
+def do_the_split(key, file_key, field_defs, filename):
+    """
+      Uploads with up to SHARD_ROWS rows are geomanced right here, like
+      do_the_work does. Bigger ones are split into shards of SHARD_ROWS
+      rows that are queued as separate do_the_shard jobs, so every free
+      worker can pick one up. The worker that finishes the last shard
+      merges the results.
+
+      Either way the result ends up under key, which enqueue_work handed
+      to the client. This job and its shards are queued without result
+      keys of their own.
+    """
+    try:
+        with closing(blob_store.open(file_key)) as contents:
+            shard_keys, header_row = split_rows(contents, SHARD_ROWS)
+        if not shard_keys:
+            rv = do_the_work(file_key, field_defs, filename)
+            redis.setex(key, dumps({'status': 'ok', 'result': rv}), RESULT_TTL)
+            return None
+    except Exception, e:
+        redis.setex(key, dumps(error_result(e)), RESULT_TTL)
+        raise
+    meta = {
+        'filename': filename,
+        'field_defs': field_defs,
+        'header_row': header_row,
+        'num_shards': len(shard_keys),
+    }
+    redis.setex('%s:meta' % key, dumps(meta), BLOB_TTL)
+    for idx, shard_key in enumerate(shard_keys):
+        do_the_shard.enqueue(key, idx, shard_key, field_defs)
+    return None
+
+def split_rows(contents, shard_rows):
+    """
+      Splits the rows in the file object contents into CSV files of
+      shard_rows rows each, every one with a copy of the header row, and
+      stores them in the blob store. Returns the list of their keys in
+      row order along with the header row. When everything fits in one
+      shard nothing is stored and the list is empty. Shard blobs are
+      content addressed and may be shared with another job, so they are
+      left to expire with BLOB_TTL rather than deleted.
+    """
+    reader = iter_rows(contents)
+    header_row = reader.next()
+    for idx, row in enumerate(reader):
+        if idx >= shard_rows:
+            break
+    else:
+        return [], header_row
+    reader = iter_rows(contents)
+    reader.next()
+    shard_keys = []
+    out = None
+    for idx, row in enumerate(reader):
+        if idx % shard_rows == 0:
+            if out is not None:
+                shard_keys.append(blob_store.put(out.getvalue()))
+            out = StringIO()
+            writer = UnicodeCSVWriter(out)
+            writer.writerow(header_row)
+        writer.writerow(row)
+    if out is not None:
+        shard_keys.append(blob_store.put(out.getvalue()))
+    return shard_keys, header_row
+
+@queuefunc
+def do_the_shard(parent_key, shard_idx, shard_key, field_defs):
+    """
+      Geomances one shard of a split upload and stores the joined rows
+      in the blob store with put_rows. The shard that completes the set
+      merges everything into the final output file. Any error fails the
+      parent job so the client polling it finds out.
+    """
+    if redis.exists(parent_key):
+        # the job has already failed on another shard
+        return None
+    try:
+        rows = []
+        with closing(blob_store.open(shard_key)) as contents:
+            response = geomance(contents, field_defs, rows.extend,
+                                allow_empty=True)
+        if not isinstance(response, dict):
+            raise MancerError(response)
+        response['header_row'] = rows[0]
+        response['file_key'] = put_rows(rows[1:])
+        del rows
+        shards_key = '%s:shards' % parent_key
+        redis.hset(shards_key, shard_idx, dumps(response))
+        redis.expire(shards_key, BLOB_TTL)
+        done = redis.incr('%s:done' % parent_key)
+        redis.expire('%s:done' % parent_key, BLOB_TTL)
+        meta = loads(redis.get('%s:meta' % parent_key))
+        if done == meta['num_shards']:
+            rv = {'status': 'ok', 'result': merge_shards(parent_key, meta)}
+            redis.setex(parent_key, dumps(rv), RESULT_TTL)
+    except Exception, e:
+        if redis.setnx(parent_key, dumps(error_result(e))):
+            redis.expire(parent_key, RESULT_TTL)
+        raise
+
+def merge_shards(parent_key, meta):
+    """
+      Writes the joined rows of every shard, in the original row order,
+      to the output file and returns the combined response. Shards can
+      come back with different appended columns (or none at all when
+      nothing in them matched), so columns are lined up by name.
+    """
+    shards_key = '%s:shards' % parent_key
+    shards = [loads(redis.hget(shards_key, idx)) \
+              for idx in range(meta['num_shards'])]
+    if not any([s['num_matches'] for s in shards]):
+        raise MancerError('No geographies matched')
+    header_row = meta['header_row']
+
+    def column_keys(header):
+        # (name, occurrence) pairs keep repeated column names apart
+        seen = {}
+        keys = []
+        for col in header[len(header_row):]:
+            seen[col] = seen.get(col, 0) + 1
+            keys.append((col, seen[col]))
+        return keys
+
+    appended = OrderedDict()
+    for shard in shards:
+        for col_key in column_keys(shard['header_row']):
+            if col_key not in appended:
+                appended[col_key] = len(header_row) + len(appended)
+    output_header = header_row + [name for name, n in appended.keys()]
+
+    def merged_rows():
+        yield output_header
+        for shard in shards:
+            positions = [appended[k] for k in column_keys(shard['header_row'])]
+            for row in get_rows(shard['file_key']):
+                out_row = row[:len(header_row)]
+                out_row.extend([''] * (len(output_header) - len(out_row)))
+                for pos, val in zip(positions, row[len(header_row):]):
+                    out_row[pos] = val
+                yield out_row
+
+    fname, fpath = output_path(meta['filename'])
+    write_output(fpath, merged_rows())
+    redis.delete(shards_key, '%s:done' % parent_key, '%s:meta' % parent_key)
+    num_rows = sum([s['num_rows'] for s in shards])
+    num_missing = sum([s['num_missing'] for s in shards])
+    return {
+        'download_url': '/download/%s' % fname,
+        'geo_col': shards[0]['geo_col'],
+        'num_rows': num_rows,
+        'num_matches': num_rows - num_missing,
+        'num_missing': num_missing,
+        'cols_added': list(set(output_header) - set(header_row)),
+        'errors': shards[0]['errors'],
+    }
+
+def output_path(filename):
+    """
+      Returns the name and full path of a new output file for filename
+    """
     name, ext = os.path.splitext(filename)
     fname = '%s_%s%s' % (name, datetime.now().isoformat(), ext)
     fpath = '%s/%s' % (RESULT_FOLDER, fname)
-    if ext == '.xlsx':
-        writeXLSX(fpath, output)
-    elif ext == '.xls':
-        writeXLS(fpath, output)
-    else:
-        writeCSV(fpath, output)
-    response['download_url'] = '/download/%s' % fname
-    response['num_matches'] = response['num_rows'] - response['num_missing']
-    response['cols_added'] = list(set(header_row) - set(response['cols_added']))
-    return response
+    return fname, fpath
+
+def write_output(fpath, rows):
+    """
+      Streams rows to fpath in the format its extension asks for
+    """
+    with get_writer(fpath) as writer:
+        writer.writerows(rows)
+
+def put_rows(rows):
+    """
+      Stores a list of rows in the blob store and returns its key. The
+      rows are pickled rather than written as CSV so numbers come back
+      as numbers, and end up as numeric cells in .xls and .xlsx output.
+    """
+    return blob_store.put(dumps(rows, -1))
+
+def get_rows(file_key):
+    """
+      Returns the list of rows put_rows stored under file_key
+    """
+    with closing(blob_store.open(file_key)) as f:
+        return loads(f.read())
 
-def writeXLS(fpath, output):
-    with open(fpath, 'wb') as f:
-        workbook = xlwt.Workbook(encoding='utf-8')
-        sheet = workbook.add_sheet('Geomancer Output')
-        for r, row in enumerate(output):
-            if row:
-                for c, col in enumerate(output[0]):
-                    sheet.write(r, c, row[c])
-        workbook.save(fpath)
-
-def writeXLSX(fpath, output):
-    with open(fpath, 'wb') as f:
-        workbook = Workbook()
-        sheet = workbook.active
-        sheet.title = 'Geomancer Output'
-        numcols = len(output[0])
-        for r, row in enumerate(output):
-            if row:
-                sheet.append([row[col_idx] for col_idx in range(numcols)])
-        workbook.save(fpath)
-
-def writeCSV(fpath, output):
-    with open(fpath, 'wb') as f:
-        writer = UnicodeCSVWriter(f)
-        writer.writerows(output)
-
-def queue_daemon(app, rv_ttl=500):
+def iter_rows(contents):
+    """
+      Returns a reader that yields the rows of the file object contents
+      one at a time, header row first. Every call starts over from the top.
+    """
+    contents.seek(0)
+    return UnicodeCSVReader(contents)
+
+def error_result(e):
+    try:
+        if e.body:
+            return {'status': 'error', 'result': '{0} message: {1}'.format(e.message, e.body)}
+        else:
+            return {'status': 'error', 'result': e.message}
+    except AttributeError:
+        return {'status': 'error', 'result': 'Error: {0}'.format(e.message)}
+
+_stopping = False
+
+def _stop(signum, frame):
+    global _stopping
+    _stopping = True
+
+def queue_daemon(app, rv_ttl=RESULT_TTL):
+    """
+      Pulls jobs off the queue one at a time until SIGTERM or SIGINT is
+      received. A job that is running when the signal arrives is finished
+      and its result stored before the loop exits.
+    """
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, _stop)
+        # let the blocking pop resume instead of failing with EINTR
+        signal.siginterrupt(sig, False)
     print 'Mancing commencing...'
-    while 1:
-        msg = redis.blpop(app.config['REDIS_QUEUE_KEY'])
+    while not _stopping:
+        msg = redis.blpop(app.config['REDIS_QUEUE_KEY'], timeout=5)
+        if msg is None:
+            continue
         func, key, args, kwargs = loads(msg[1])
         try:
-            rv = func(*args, **kwargs)
+            # jobs may queue more jobs, which needs the app's config
+            with app.app_context():
+                rv = func(*args, **kwargs)
             rv = {'status': 'ok', 'result': rv}
         except Exception, e:
             if client:
                 client.captureException()
             tb = traceback.format_exc()
             print tb
-            try:
-                if e.body:
-                    rv = {'status': 'error', 'result': '{0} message: {1}'.format(e.message, e.body)}
-                else:
-                    rv = {'status': 'error', 'result': e.message}
-            except AttributeError:
-                rv = {'status': 'error', 'result': 'Error: {0}'.format(e.message)}
-        if rv is not None:
+            rv = error_result(e)
+        if key is not None:
             redis.set(key, dumps(rv))
             redis.expire(key, rv_ttl)
+
+def preload():
+    """
+      Loads everything the workers share before they are forked so
+      the children get it copy-on-write instead of building it per job.
+    """
+    registry.preload()
+    gazetteer.preload()
+
+def worker_pool(app, processes=WORKER_PROCESSES, rv_ttl=RESULT_TTL):
+    """
+      Supervises a pool of forked queue_daemon processes. Children that
+      die are replaced. SIGTERM or SIGINT is passed on to the children,
+      which finish the job they are working on before exiting, and the
+      pool returns once all of them are gone.
+    """
+    preload()
+    children = set()
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # until queue_daemon installs its own handlers, a signal must
+            # not run terminate() against this copy of children
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                queue_daemon(app, rv_ttl=rv_ttl)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children.add(pid)
+
+    def terminate(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    for i in range(processes):
+        spawn()
+    print 'Started %s workers' % processes
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            break
+        children.discard(pid)
+        if not stopping:
+            print 'Worker %s exited with status %s, restarting' % (pid, status)
+            # keep a worker that dies right away from spinning
+            time.sleep(1)
+            spawn()
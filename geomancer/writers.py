@@ -0,0 +1,137 @@
+import os
+import xlwt
+from openpyxl import Workbook
+from csvkit.unicsv import UnicodeCSVWriter
+
+SHEET_TITLE = 'Geomancer Output'
+
+class OutputWriter(object):
+    """
+    Base class for output writers. Rows are handed over one at a time (or
+    as any iterable through writerows), header row first, and nothing is
+    kept around that would grow with the number of rows. close() finishes
+    the file; writers also work as context managers.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+
+    def writerow(self, row):
+        raise NotImplementedError
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+class CSVWriter(OutputWriter):
+    """
+    Buffers buffer_rows rows at a time before handing them to the CSV writer.
+    """
+
+    def __init__(self, fpath, buffer_rows=1000):
+        super(CSVWriter, self).__init__(fpath)
+        self.f = open(fpath, 'wb')
+        self.writer = UnicodeCSVWriter(self.f)
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class XLSWriter(OutputWriter):
+    """
+    Writes .xls files with xlwt. Finished rows are serialized every
+    buffer_rows rows so xlwt does not keep a cell object for each of them.
+    A sheet holds at most max_rows rows; past that, the writer starts a new
+    sheet that repeats the header row.
+    """
+    max_rows = 65536
+
+    def __init__(self, fpath, buffer_rows=1000):
+        super(XLSWriter, self).__init__(fpath)
+        self.workbook = xlwt.Workbook(encoding='utf-8')
+        self.buffer_rows = buffer_rows
+        self.header = None
+        self.sheet = None
+        self.sheet_count = 0
+        self.row_idx = 0
+
+    def _add_sheet(self):
+        self.sheet_count += 1
+        title = SHEET_TITLE
+        if self.sheet_count > 1:
+            title = '%s (%s)' % (SHEET_TITLE, self.sheet_count)
+        self.sheet = self.workbook.add_sheet(title)
+        self.row_idx = 0
+        if self.header is not None:
+            self._write(self.header)
+
+    def _write(self, row):
+        sheet_row = self.sheet.row(self.row_idx)
+        for c, val in enumerate(row):
+            sheet_row.write(c, val)
+        self.row_idx += 1
+        if self.row_idx % self.buffer_rows == 0:
+            self.sheet.flush_row_data()
+
+    def writerow(self, row):
+        if self.sheet is None:
+            self._add_sheet()
+            self.header = row
+        elif self.row_idx >= self.max_rows:
+            self.sheet.flush_row_data()
+            self._add_sheet()
+        self._write(row)
+
+    def close(self):
+        if self.sheet is None:
+            self._add_sheet()
+        self.workbook.save(self.fpath)
+
+class XLSXWriter(OutputWriter):
+    """
+    Writes .xlsx files with openpyxl's write-only mode, which streams rows
+    to a temporary file instead of keeping a cell object for each of them.
+    """
+
+    def __init__(self, fpath):
+        super(XLSXWriter, self).__init__(fpath)
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet(title=SHEET_TITLE)
+
+    def writerow(self, row):
+        self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.fpath)
+
+def get_writer(fpath):
+    """
+    Returns a writer for fpath that matches the format of its extension.
+    Anything that is not .xls or .xlsx is written as CSV.
+    """
+    ext = os.path.splitext(fpath)[1]
+    if ext == '.xlsx':
+        return XLSXWriter(fpath)
+    elif ext == '.xls':
+        return XLSWriter(fpath)
+    return CSVWriter(fpath)
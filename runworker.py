@@ -1,6 +1,12 @@
-from geomancer.worker import queue_daemon
+from geomancer.worker import worker_pool, WORKER_PROCESSES
 from geomancer import create_app
 
 app = create_app()
 
-queue_daemon(app)
+if __name__ == "__main__":
+    import sys
+    try:
+        processes = int(sys.argv[1])
+    except IndexError:
+        processes = WORKER_PROCESSES
+    worker_pool(app, processes=processes)
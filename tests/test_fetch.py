@@ -0,0 +1,102 @@
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingTCPServer
+from geomancer.mancers.base import BaseMancer
+from geomancer.mancers.fetch import FetchEngine, host_limiter
+
+class StubServer(ThreadingTCPServer):
+    """
+    Answers every GET with its own path after delay seconds and keeps
+    track of the most requests it had in flight at once.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay=0.05):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.hits = 0
+
+    @property
+    def host(self):
+        return '127.0.0.1:%s' % self.server_address[1]
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.path)))
+        self.end_headers()
+        self.wfile.write(self.path)
+
+    def log_message(self, *args):
+        pass
+
+class StubMancer(BaseMancer):
+    machine_name = 'stub'
+
+    def __init__(self, base_url):
+        super(StubMancer, self).__init__(retry_attempts=0)
+        self.base_url = base_url
+        # every request has to reach the stub server
+        self.cache_storage = None
+
+class FetchEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.mancer = StubMancer('http://%s' % self.server.host)
+        self.engine = FetchEngine(threads=10)
+
+    def tearDown(self):
+        host_limiter.limits.pop(self.server.host, None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, i):
+        return self.mancer.urlopen('%s/%s' % (self.mancer.base_url, i))
+
+    def test_results_in_order(self):
+        results = self.engine.map(self.fetch, range(20), 10)
+        self.assertEqual(results, ['/%s' % i for i in range(20)])
+        self.assertEqual(self.server.hits, 20)
+        self.assertTrue(self.server.max_in_flight > 1)
+
+    def test_host_limit(self):
+        host_limiter.limits[self.server.host] = 2
+        results = self.engine.map(self.fetch, range(12), 10)
+        self.assertEqual(results, ['/%s' % i for i in range(12)])
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_first_error_is_raised(self):
+        def fetch(i):
+            if i == 3:
+                raise ValueError(i)
+            return self.fetch(i)
+        self.assertRaises(ValueError, self.engine.map, fetch, range(10), 4)
+
+    def test_nested_map_runs_inline(self):
+        def outer(i):
+            return self.engine.map(self.fetch, range(i), 10)
+        results = self.engine.map(outer, range(4), 4)
+        self.assertEqual(results, [['/%s' % j for j in range(i)] for i in range(4)])
+
+if __name__ == '__main__':
+    unittest.main()
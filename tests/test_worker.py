@@ -0,0 +1,64 @@
+import shutil
+import tempfile
+import unittest
+from pickle import dumps
+from openpyxl import load_workbook
+from geomancer import worker
+from geomancer.blob_store import RedisBlobStore
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+@unittest.skipIf(fakeredis is None, 'needs fakeredis')
+class MergeShardsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.redis.flushall()
+        self.folder = tempfile.mkdtemp()
+        self.saved = worker.redis, worker.blob_store, worker.RESULT_FOLDER
+        worker.redis = self.redis
+        worker.blob_store = RedisBlobStore(redis=self.redis)
+        worker.RESULT_FOLDER = self.folder
+
+    def tearDown(self):
+        worker.redis, worker.blob_store, worker.RESULT_FOLDER = self.saved
+        shutil.rmtree(self.folder)
+
+    def add_shard(self, idx, header_row, rows, num_matches):
+        response = {
+            'header_row': header_row,
+            'file_key': worker.put_rows(rows),
+            'geo_col': 'state',
+            'num_rows': len(rows),
+            'num_matches': num_matches,
+            'num_missing': len(rows) - num_matches,
+            'errors': [],
+        }
+        self.redis.hset('job:shards', idx, dumps(response))
+
+    def test_xlsx_numbers_stay_numbers(self):
+        header_row = [u'name', u'state']
+        self.add_shard(0, header_row + [u'Population (State)'],
+                       [[u'a', u'IL', 12830632], [u'b', u'xx', u'']], 1)
+        self.add_shard(1, header_row + [u'Population (State)', u'Median age (State)'],
+                       [[u'c', u'CA', 37253956, 35.2]], 1)
+        meta = {'filename': u'big.xlsx', 'header_row': header_row, 'num_shards': 2}
+        response = worker.merge_shards('job', meta)
+
+        fname = response['download_url'].rsplit('/', 1)[1]
+        sheet = load_workbook('%s/%s' % (self.folder, fname)).active
+        rows = [[c.value for c in row] for row in sheet.rows]
+        self.assertEqual(rows[0], [u'name', u'state', u'Population (State)',
+                                   u'Median age (State)'])
+        self.assertEqual(rows[1][:3], [u'a', u'IL', 12830632])
+        self.assertEqual(rows[3], [u'c', u'CA', 37253956, 35.2])
+        self.assertTrue(isinstance(rows[1][2], (int, long)))
+        self.assertTrue(isinstance(rows[3][3], float))
+        self.assertEqual(response['num_rows'], 3)
+        self.assertEqual(response['num_matches'], 2)
+
+if __name__ == '__main__':
+    unittest.main()